@@ -1,7 +1,15 @@
-from flask import Flask, redirect, render_template, url_for
+import json
+import mimetypes
+
+from os.path import isfile, join
+
+from flask import Flask, Response, jsonify, redirect, render_template, request, url_for
+from flask import send_from_directory
 app = Flask("SaltPad", template_folder="templates")
 
 from core import SaltStackClient
+from assets import BUNDLES, DIST_DIR, load_manifest
+from export import EXPORT_FIELDS, EXPORT_FORMATS, parse_since, serialize
 
 class groupby(dict):
     def __init__(self, seq, key=lambda x:x):
@@ -11,9 +19,23 @@ class groupby(dict):
     __iter__ = dict.iteritems
 
 client = SaltStackClient()
+assets_manifest = load_manifest()
 statuses = {False: 2, None: 1, True: 0}
 reverse_statues = {v:k for k, v in statuses.items()}
 human_status = {False: 'warning', None: 'warning', True: 'success'}
+summary_levels = {'success': True, 'changes': None, 'failed': False}
+snapshot_columns = {
+    'grains': ['os', 'osrelease', 'roles', 'saltversion', 'num_cpus', 'mem_total'],
+    'pillar': [],
+}
+
+
+def get_path(data, path):
+    for key in path.split('.'):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
 
 
 def parse_step_name(step_name):
@@ -33,7 +55,8 @@ def process_sync_status(status):
     output = {}
     if status.get('return'):
         for k, v in status['return'].items():
-            # Clean v
+            # Clean a copy of v, status may be cached
+            v = dict(v)
             result = v.pop('result')
             v.pop('__run_num__')
             v.pop('name')
@@ -50,6 +73,9 @@ def process_sync_jobs(jobs):
         if job.get('return'):
             job_result['level'] = get_job_status(job['return'])
             job_result['status'] = human_status[job_result['level']]
+        elif job.get('summary'):
+            job_result['level'] = summary_levels[job['summary']['status']]
+            job_result['status'] = human_status[job_result['level']]
         job_result['date'] = job['_id'].generation_time
         job_result['jid'] = job['jid']
         result.append(job_result)
@@ -59,6 +85,8 @@ def process_sync_jobs(jobs):
 def get_latest_job_status(jobs):
     result = None
     for job in jobs:
+        if job.get('summary'):
+            return summary_levels[job['summary']['status']]
         if not job.get('return'):
             continue
         job_status = get_job_status(job['return'])
@@ -68,6 +96,35 @@ def get_latest_job_status(jobs):
             return job_status
 
 
+@app.template_global()
+def asset_urls(bundle):
+    """Urls to include bundle, sources one by one while assets are not built"""
+    if bundle in assets_manifest:
+        return [url_for('built_asset', filename=assets_manifest[bundle])]
+    return [url_for('static', filename=path) for path in BUNDLES[bundle]]
+
+
+# Takes precedence over the static route, relative urls of built CSS are
+# resolved from static/dist
+@app.route("/static/dist/<path:filename>")
+def built_asset(filename):
+    """Serve built assets precompressed when the client accepts it, their
+    name changes with their content so they can be cached forever.
+    """
+    accept_encoding = request.headers.get('Accept-Encoding', '')
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in accept_encoding and isfile(join(DIST_DIR, filename + suffix)):
+            response = send_from_directory(DIST_DIR, filename + suffix,
+                mimetype=mimetype, conditional=True)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(DIST_DIR, filename, conditional=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
 
 @app.route("/")
 def index():
@@ -76,21 +133,32 @@ def index():
     for minion in (minions['up'] + minions['down']):
         status = get_latest_job_status(client.get_multiple_job_status(minion,
             "state_hightest_test", max=2))
-        if status == 'success':
+        if status is True:
             ok_status += 1
+    resolution = request.args.get('resolution', 'hour')
+    sync_health = [dict(point, time=point['time'].strftime('%Y-%m-%d %H:%M'))
+                   for point in client.get_sync_health(resolution)]
     return render_template('dashboard.html', minions=client.minions,
-        ok_status=ok_status)
+        ok_status=ok_status, sync_health=json.dumps(sync_health),
+        resolution=resolution, masters=client.master_latencies())
 
 @app.route("/minions")
 def minions_status():
     minions = client.minions
+    query = request.args.get('q', '')
+    if query:
+        try:
+            matching = set(client.query(query))
+        except ValueError as e:
+            return str(e), 400
+        minions = {'up': [m for m in minions['up'] if m in matching],
+                   'down': [m for m in minions['down'] if m in matching]}
     jobs = {}
-    versions = {}
     for minion in (minions['up']):
         jobs[minion] = process_sync_jobs(client.get_multiple_job_status(minion, "state_hightest_test"))
-        versions[minion] = client.cmd(minion, 'test.version')[minion]
+    versions = client.versions(minions['up'])
     return render_template('minions.html', minions=minions, jobs=jobs,
-        roles=client.minions_roles, versions=versions)
+        roles=client.minions_roles(), versions=versions, query=query)
 
 @app.route("/minions/<minion>/check_sync/<jid>")
 def minions_show_check_status(minion, jid):
@@ -106,9 +174,120 @@ def minions_do_check_sync(minion):
     return redirect(url_for('minions_show_check_status', minion=minion, jid=jid))
 
 
+def snapshot_view(kind):
+    key = request.args.get('key') or None
+    value = request.args.get('value') or None
+    columns = [key] if key else snapshot_columns[kind]
+
+    rows = []
+    for doc in client.search_snapshot(kind, key, value, fields=columns):
+        values = [get_path(doc['data'], column) for column in columns]
+        rows.append((doc['_id'], values, doc['updated']))
+
+    return render_template('snapshot.html', kind=kind, key=key, value=value,
+        columns=columns, rows=rows)
+
+@app.route("/grains")
+def grains():
+    return snapshot_view('grains')
+
+@app.route("/pillar")
+def pillar():
+    return snapshot_view('pillar')
+
+@app.route("/<any(grains, pillar):kind>/refresh")
+def refresh_snapshot(kind):
+    client.refresh_snapshot(kind)
+    return redirect(url_for(kind))
+
+@app.route("/minions/<minion>/<any(grains, pillar):kind>")
+def minion_snapshot(minion, kind):
+    snapshot = client.get_snapshot(kind, minion)
+    if not snapshot:
+        return "No %s cached for this minion" % kind, 404
+    data = [(k, json.dumps(v, indent=2, sort_keys=True, default=str))
+            for k, v in sorted(snapshot['data'].items())]
+    return render_template('snapshot_detail.html', kind=kind, minion=minion,
+        data=data, updated=snapshot['updated'])
+
+
+@app.route("/minions/<minion>/diff")
+@app.route("/minions/<minion>/diff/<old_jid>/<new_jid>")
+def minion_diff(minion, old_jid=None, new_jid=None):
+    if old_jid is None:
+        jids = client.latest_jids(minion)
+        if len(jids) < 2:
+            return "Less than two finished jobs on this minion", 404
+        new_jid, old_jid = jids
+    try:
+        diff = client.diff_jobs(minion, old_jid, new_jid)
+    except ValueError as e:
+        return str(e), 404
+    if request.args.get('format') == 'json':
+        return jsonify(diff)
+    return render_template('diff.html', minion=minion, old_jid=old_jid,
+        new_jid=new_jid, diff=diff)
+
+@app.route("/compare")
+def compare():
+    role = request.args.get('role') or None
+    patterns = request.args.get('minions', '').split() or None
+    minions = client.select_minions(role, patterns)
+    differing = client.compare_minions(minions)
+    if request.args.get('format') == 'json':
+        return jsonify(differing)
+    return render_template('compare.html', role=role,
+        patterns=request.args.get('minions', ''), minions=minions,
+        differing=sorted(differing.items()))
+
+@app.route("/profile")
+def profile():
+    role = request.args.get('role') or None
+    key = request.args.get('key') or None
+    runs = max(request.args.get('runs', 10, type=int) or 10, 1)
+    minions = client.select_minions(role)
+    return render_template('profile.html', role=role, key=key, runs=runs,
+        profile=client.profile(minions, key, runs))
+
+
 @app.route("/deployments")
 def deployments():
-    return ""
+    return render_template('deployments.html',
+        deployments=client.get_deployments(),
+        days=client.get_deployment_rollups('day'),
+        roles=client.get_deployment_rollups('role', limit=None))
+
+@app.route("/api/deployments")
+def deployments_api():
+    deployments = client.get_deployments()
+    for deployment in deployments:
+        deployment['_id'] = str(deployment['_id'])
+    return jsonify(deployments=deployments,
+        days=client.get_deployment_rollups('day'),
+        roles=client.get_deployment_rollups('role', limit=None))
+
+@app.route("/api/cache")
+def cache_api():
+    # Counters are per web worker, the Mongo cache size is shared
+    return jsonify(client.cache_stats())
+
+@app.route("/api/export/<kind>")
+def export(kind):
+    fmt = request.args.get('format', 'ndjson')
+    if kind not in EXPORT_FIELDS or fmt not in EXPORT_FORMATS:
+        return "Unknown export %s in format %s" % (kind, fmt), 404
+    try:
+        since = parse_since(request.args['since']) if request.args.get('since') else None
+    except ValueError:
+        return "since should be a YYYY-MM-DD date", 400
+
+    rows = client.export(kind, role=request.args.get('role') or None,
+        patterns=request.args.get('minions', '').split() or None,
+        key=request.args.get('key') or None, since=since)
+    # Rows are serialized while the response is written, never all at once
+    response = Response(serialize(rows, kind, fmt), mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (kind, fmt)
+    return response
 
 if __name__ == "__main__":
     print "Start ?"
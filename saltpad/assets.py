@@ -0,0 +1,170 @@
+# Build static assets bundles, run `make assets` after changing any asset
+# and `make vendor` to refresh vendored ones
+import re
+import os
+import sys
+import gzip
+import json
+import urllib2
+
+from hashlib import sha1
+from os.path import abspath, dirname, exists, join, normpath, relpath
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from rjsmin import jsmin
+except ImportError:
+    jsmin = None
+
+
+STATIC_DIR = join(dirname(abspath(__file__)), 'static')
+DIST_DIR = join(STATIC_DIR, 'dist')
+MANIFEST_FILE = join(DIST_DIR, 'manifest.json')
+
+# External assets are committed in static/vendor, builds and pages never
+# reach the CDN. These urls are only used by `make vendor` to refresh them.
+VENDOR_ASSETS = {
+    'vendor/morris-0.5.0.min.css': 'https://cdnjs.cloudflare.com/ajax/libs/morris.js/0.5.0/morris.css',
+    'vendor/morris-0.5.0.min.js': 'https://cdnjs.cloudflare.com/ajax/libs/morris.js/0.5.0/morris.min.js',
+    'vendor/raphael-2.1.2.min.js': 'https://cdnjs.cloudflare.com/ajax/libs/raphael/2.1.2/raphael-min.js',
+}
+
+BUNDLES = {
+    'saltpad.css': ['css/bootstrap.css', 'css/sb-admin.css',
+                    'font-awesome/css/font-awesome.min.css',
+                    'vendor/morris-0.5.0.min.css', 'css/saltpad.css'],
+    'saltpad.js': ['js/jquery-1.10.2.js', 'js/bootstrap.js',
+                   'vendor/raphael-2.1.2.min.js', 'vendor/morris-0.5.0.min.js',
+                   'js/tablesorter/jquery.tablesorter.js', 'js/tablesorter/tables.js'],
+}
+
+CSS_URL_RE = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+CSS_COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+CSS_SPACES_RE = re.compile(r'\s*([{};,])\s*')
+
+
+def vendor_assets(static_dir=STATIC_DIR):
+    """Download vendored assets again from their upstream urls"""
+    for path, url in sorted(VENDOR_ASSETS.items()):
+        destination = join(static_dir, path)
+        if not exists(dirname(destination)):
+            os.makedirs(dirname(destination))
+        content = urllib2.urlopen(url, timeout=30).read()
+        with open(destination, 'wb') as f:
+            f.write(content)
+        print "Vendored %s from %s" % (path, url)
+
+
+def rebase_css_urls(content, path):
+    """Rewrite relative urls of a CSS file at path so they still resolve from
+    the dist directory.
+    """
+    source_dir = dirname(path)
+
+    def rebase(match):
+        url = match.group(2)
+        if url.startswith(('data:', 'http:', 'https:', '/', '#')):
+            return match.group(0)
+        rebased = relpath(normpath(join(source_dir, url)), 'dist')
+        return "url('%s')" % rebased.replace(os.sep, '/')
+    return CSS_URL_RE.sub(rebase, content)
+
+
+def minify_css(content):
+    content = CSS_COMMENT_RE.sub('', content)
+    content = CSS_SPACES_RE.sub(r'\1', content)
+    return re.sub(r'\s+', ' ', content).replace(';}', '}').strip()
+
+
+def minify_js(content):
+    # Without rjsmin, sources are only concatenated, gzip does most of the job
+    if jsmin is None:
+        return content
+    return jsmin(content)
+
+
+def build_bundle(name, paths, static_dir=STATIC_DIR):
+    contents = []
+    for path in paths:
+        with open(join(static_dir, path)) as f:
+            content = f.read()
+        if name.endswith('.css'):
+            contents.append(minify_css(rebase_css_urls(content, path)))
+        else:
+            contents.append(minify_js(content))
+    # A source missing its trailing semicolon must not run into the next one
+    return ('\n;\n' if name.endswith('.js') else '\n').join(contents)
+
+
+def write_compressed(path, content):
+    """Write gzip and, if available, brotli versions of content next to path,
+    served as is to clients accepting them.
+    """
+    # mtime=0 keeps the gzip file identical between builds of the same content
+    with open(path + '.gz', 'wb') as raw:
+        with gzip.GzipFile(filename='', mode='wb', compresslevel=9,
+                           fileobj=raw, mtime=0) as f:
+            f.write(content)
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(content))
+
+
+def build_assets(static_dir=STATIC_DIR):
+    """Build every bundle into dist with its content hash in its name and
+    write the manifest mapping bundles to built files.
+    """
+    missing = [path for path in sorted(VENDOR_ASSETS)
+               if not exists(join(static_dir, path))]
+    if missing:
+        raise IOError("Missing vendored assets %s" % ", ".join(missing))
+
+    dist_dir = join(static_dir, 'dist')
+    if not exists(dist_dir):
+        os.makedirs(dist_dir)
+
+    manifest = {}
+    for name, paths in sorted(BUNDLES.items()):
+        content = build_bundle(name, paths, static_dir)
+        base, extension = name.rsplit('.', 1)
+        filename = '%s.%s.%s' % (base, sha1(content).hexdigest()[:12], extension)
+        with open(join(dist_dir, filename), 'wb') as f:
+            f.write(content)
+        write_compressed(join(dist_dir, filename), content)
+        manifest[name] = filename
+        print "Built %s (%d bytes)" % (filename, len(content))
+
+    # Forget bundles of previous builds
+    built = set(manifest.values())
+    for filename in os.listdir(dist_dir):
+        built_name = filename[:-3] if filename.endswith(('.gz', '.br')) else filename
+        if built_name not in built and filename != 'manifest.json':
+            os.remove(join(dist_dir, filename))
+
+    with open(join(dist_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(manifest_file=MANIFEST_FILE):
+    """Return the bundles manifest, empty when assets were not built"""
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+if __name__ == '__main__':
+    try:
+        if '--refresh-vendor' in sys.argv[1:]:
+            vendor_assets()
+        else:
+            build_assets()
+    except (IOError, urllib2.URLError) as e:
+        print e
+        sys.exit(1)
@@ -0,0 +1,232 @@
+from bson import BSON
+from bson.binary import Binary
+from bson.errors import InvalidBSON
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import wraps
+from pymongo.errors import DuplicateKeyError
+from threading import Lock, RLock
+from time import sleep, time
+
+
+def make_key(value):
+    """Turn lists and dicts found in arguments into hashable tuples"""
+    if isinstance(value, (list, tuple)):
+        return tuple(make_key(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, make_key(v)) for k, v in value.items()))
+    return value
+
+
+class TTLCache(object):
+    """Size-bounded LRU cache whose entries expire after a TTL.
+
+    Keys are (name, args, kwargs) tuples as built by memoize, so every
+    entry of a name can be invalidated at once. A None ttl never expires.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = RLock()
+        self._key_locks = {}
+
+    def get(self, key):
+        """Return cached value, raise KeyError if missing or expired"""
+        with self._lock:
+            try:
+                value = self.peek(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.hits += 1
+            return value
+
+    def peek(self, key):
+        """Same as get without counting a hit or a miss"""
+        with self._lock:
+            expires, value = self._entries.pop(key)
+            if expires is not None and expires < time():
+                raise KeyError(key)
+
+            # Mark as most recently used
+            self._entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else time() + ttl
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, name=None, *args):
+        """Drop every entry, every entry of name or the entry of name called
+        with args.
+        """
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            elif args:
+                self._entries.pop((name, make_key(args), ()), None)
+            else:
+                for key in [k for k in self._entries if k[0] == name]:
+                    del self._entries[key]
+
+    @contextmanager
+    def lock(self, key):
+        """Serialize computations of key between threads. Each key lock counts
+        its users and is dropped by the last one, so locks do not outlive the
+        computations they guard.
+        """
+        with self._lock:
+            key_lock, users = self._key_locks.get(key, (None, 0))
+            if key_lock is None:
+                key_lock = Lock()
+            self._key_locks[key] = (key_lock, users + 1)
+        try:
+            with key_lock:
+                yield
+        finally:
+            with self._lock:
+                key_lock, users = self._key_locks[key]
+                if users == 1:
+                    del self._key_locks[key]
+                else:
+                    self._key_locks[key] = (key_lock, users - 1)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._entries),
+                'maxsize': self.maxsize}
+
+
+class MongoCache(object):
+    """Cache shared by several processes through Mongo, with the same
+    interface as TTLCache.
+
+    Values are BSON encoded in a `cache` collection and expired by a TTL
+    index, never pickled: the database is writable from minion returners and
+    must not be able to run code in SaltPad. Tuples come back as lists.
+    Computations are single-flight across processes: the first one to miss
+    takes a lock in a `cache_locks` collection and the others wait for its
+    result instead of all hitting the salt master.
+    """
+
+    def __init__(self, db, ttl=60, lock_timeout=120, poll_interval=0.1):
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.hits = 0
+        self.misses = 0
+
+        self.entries = db['cache']
+        self.entries.ensure_index('name')
+        self.entries.ensure_index('expires', expireAfterSeconds=0)
+        self.locks = db['cache_locks']
+        self.locks.ensure_index('expires', expireAfterSeconds=0)
+
+    def get(self, key):
+        try:
+            value = self.peek(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return value
+
+    def peek(self, key):
+        """Same as get without counting a hit or a miss"""
+        doc = self.entries.find_one({'_id': repr(key)})
+        # The TTL index only purges expired entries every minute
+        if doc is None or (doc['expires'] and doc['expires'] < datetime.utcnow()):
+            raise KeyError(key)
+        try:
+            return BSON(str(doc['value'])).decode()['value']
+        except (InvalidBSON, KeyError):
+            # Written by an older SaltPad or not by SaltPad at all
+            raise KeyError(key)
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else datetime.utcnow() + timedelta(seconds=ttl)
+
+        doc = {'_id': repr(key), 'name': key[0], 'expires': expires,
+               'value': Binary(BSON.encode({'value': value}))}
+        self.entries.update({'_id': doc['_id']}, doc, upsert=True)
+
+    def invalidate(self, name=None, *args):
+        if name is None:
+            self.entries.remove({})
+        elif args:
+            self.entries.remove({'_id': repr((name, make_key(args), ()))})
+        else:
+            self.entries.remove({'name': name})
+
+    @contextmanager
+    def lock(self, key):
+        """Serialize computations of key between processes"""
+        lock_id = repr(key)
+        while True:
+            now = datetime.utcnow()
+            try:
+                self.locks.insert({'_id': lock_id,
+                    'expires': now + timedelta(seconds=self.lock_timeout)})
+                break
+            except DuplicateKeyError:
+                # Take over locks left by dead processes
+                self.locks.remove({'_id': lock_id, 'expires': {'$lt': now}})
+                sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            self.locks.remove({'_id': lock_id})
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': self.entries.count()}
+
+
+def memoize(ttl=None, cache_if=None):
+    """Cache method results in the instance `cache` attribute, keyed by
+    method name and arguments. Results are only cached when cache_if, if
+    given, returns True for them. Concurrent misses on the same key compute
+    it only once.
+    """
+    def decorator(fn):
+        name = fn.__name__
+
+        @wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            key = (name, make_key(args), make_key(kwargs))
+            try:
+                return self.cache.get(key)
+            except KeyError:
+                pass
+
+            with self.cache.lock(key):
+                # Someone else may have computed it while we were waiting,
+                # this miss was already counted
+                try:
+                    return self.cache.peek(key)
+                except KeyError:
+                    pass
+
+                value = fn(self, *args, **kwargs)
+                if cache_if is None or cache_if(value):
+                    self.cache.set(key, value, ttl)
+                return value
+
+        return wrapper
+    return decorator
@@ -0,0 +1,90 @@
+import os
+import json
+import stat
+import fcntl
+
+from contextlib import contextmanager
+from os.path import dirname, isfile
+from tempfile import NamedTemporaryFile
+
+
+class ConfigStore(object):
+    """JSON config file shared by concurrent saltpad commands.
+
+    Reads hold a shared lock and writes an exclusive one. Updates are merged
+    into the current content of the file, which is then atomically replaced,
+    so parallel commands neither lose each other changes nor read a
+    half-written file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+
+    @contextmanager
+    def lock(self, operation):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        if not isfile(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def _mode(self):
+        """Mode of the config file, temporary files are only readable by
+        their owner.
+        """
+        if isfile(self.path):
+            return stat.S_IMODE(os.stat(self.path).st_mode)
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0666 & ~umask
+
+    def _write(self, config):
+        tmp_file = NamedTemporaryFile('w', dir=dirname(self.path),
+            prefix='.saltpad', delete=False)
+        try:
+            with tmp_file:
+                json.dump(config, tmp_file)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.chmod(tmp_file.name, self._mode())
+            os.rename(tmp_file.name, self.path)
+        except:
+            os.remove(tmp_file.name)
+            raise
+
+    def load(self):
+        with self.lock(fcntl.LOCK_SH):
+            return self._read()
+
+    @contextmanager
+    def transaction(self):
+        """Yield the current config to be modified in place, it is written
+        back on exit. Other writers wait until then.
+        """
+        with self.lock(fcntl.LOCK_EX):
+            config = self._read()
+            yield config
+            self._write(config)
+
+    def update(self, section, entries):
+        """Add or replace entries of a config section, return the new config.
+        """
+        with self.transaction() as config:
+            config.setdefault(section, {}).update(entries)
+        return config
+
+    def remove(self, section, *keys):
+        """Remove keys from a config section, return the new config.
+        """
+        with self.transaction() as config:
+            for key in keys:
+                config.get(section, {}).pop(key, None)
+        return config
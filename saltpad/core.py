@@ -1,29 +1,78 @@
 import os
 import sys
+import json
 
 import salt.config
-import salt.client
 import salt.runner
-import salt.key
 
 import pymongo
 
 from salt.output import highstate
 
-from functools import wraps
+from index import FleetIndex, parse_query
+from masters import MasterPool, load_masters
+from cache import TTLCache, MongoCache, memoize
+from jobs import get_return_status, compact_jobs, ingest_jobs, decode_return
+from jobs import summarize_return
+from jobs import record_sync_health, extract_timings, profile_timings
+from jobs import diff_returns, compare_returns
+from export import export_jobs, export_states
 
+from time import sleep, time
+from hashlib import sha1
+from fnmatch import fnmatch
+from datetime import datetime
 
-def mproperty(fn):
-    attribute = "_memo_%s" % fn.__name__
 
-    @property
-    @wraps(fn)
-    def _property(self):
-        if not hasattr(self, attribute):
-            setattr(self, attribute, fn(self))
-        return getattr(self, attribute)
+SNAPSHOT_FUNCTIONS = {'grains': 'grains.items', 'pillar': 'pillar.items'}
+
+
+def escape_keys(data):
+    """Make dict keys usable as Mongo field names, '.' and leading '$'
+    are replaced by their full-width variants.
+    """
+    if isinstance(data, dict):
+        escaped = {}
+        for key, value in data.items():
+            key = key.replace('.', u'\uff0e')
+            if key.startswith('$'):
+                key = u'\uff04' + key[1:]
+            escaped[key] = escape_keys(value)
+        return escaped
+    if isinstance(data, list):
+        return [escape_keys(value) for value in data]
+    return data
+
+
+def unescape_keys(data):
+    if isinstance(data, dict):
+        unescaped = {}
+        for key, value in data.items():
+            key = key.replace(u'\uff0e', '.')
+            if key.startswith(u'\uff04'):
+                key = '$' + key[1:]
+            unescaped[key] = unescape_keys(value)
+        return unescaped
+    if isinstance(data, list):
+        return [unescape_keys(value) for value in data]
+    return data
 
-    return _property
+
+def sync_status_of(sync_state):
+    """Return the sync status of a minion from its sync_state document"""
+    if sync_state is None:
+        return 'none'
+    running_job_id = sync_state.get('running_job_id')
+    job_id = sync_state.get('job_id')
+    if running_job_id is not None and (job_id is None or running_job_id > job_id):
+        return 'running'
+    return sync_state.get('status', 'none')
+
+
+def is_indexable(value):
+    if isinstance(value, list):
+        return all(is_indexable(item) for item in value)
+    return isinstance(value, (basestring, int, long, float, bool))
 
 
 class SaltStackClient(object):
@@ -41,28 +90,85 @@ class SaltStackClient(object):
         minion_opts = salt.config.client_config(
             os.environ.get('SALT_MINION_CONFIG', '/etc/salt/minion'))
 
-        self.local = salt.client.LocalClient()
         self.runner = salt.runner.RunnerClient(master_opts)
-        self.key = salt.key.Key(master_opts)
+        self.salt_timeout = master_opts.get('timeout', 5)
+        # Every master is queried concurrently, the fleet is their union
+        self.masters = MasterPool(load_masters(),
+            timeout=int(os.environ.get('SALTPAD_MASTERS_TIMEOUT', 10)))
 
         self.collection_name = collection_name
         self.con = pymongo.MongoClient()
         self.db = self.con[self.collection_name]
+        # Fleet-wide data lives in its own database so it cannot collide with
+        # per-minion collections
+        self.fleet_db = self.con[self.collection_name + '_fleet']
 
-        self._minions = None
+        # Web deployments with several workers should share the cache
+        if os.environ.get('SALTPAD_CACHE') == 'mongo':
+            self.cache = MongoCache(self.fleet_db)
+        else:
+            self.cache = TTLCache(maxsize=4096)
 
-        self.highstate_cache = {}
+        self.index = FleetIndex()
+        self._index_time = None
 
     @property
+    @memoize(ttl=30)
     def minions(self):
-        if self._minions is None:
-            minions = self.local.cmd('*', 'test.ping', timeout=0)
-            keys = self.key.list_keys()
-            ret = {}
-            ret['up'] = sorted(minions)
-            ret['down'] = sorted(set(keys['minions']) - set(minions))
-            self._minions = ret
-        return self._minions
+        """Return up and down minions of all masters, the master of each
+        minion and masters which did not answer in time. A minion known by
+        several masters is up if any sees it up.
+        """
+        presences = self.masters.query(lambda master: master.presence())
+        up = set()
+        known = set()
+        minion_masters = {}
+        for name in sorted(presences):
+            for minion in presences[name]['up']:
+                up.add(minion)
+                minion_masters[minion] = name
+            for minion in presences[name]['down']:
+                known.add(minion)
+                minion_masters.setdefault(minion, name)
+        ret = {}
+        ret['up'] = sorted(up)
+        ret['down'] = sorted(known - up)
+        ret['masters'] = minion_masters
+        # Minions of these masters are neither up nor down, only unknown
+        ret['unreachable'] = sorted(master.name for master in self.masters.masters
+                                    if master.name not in presences)
+        return ret
+
+    def master_of(self, minion):
+        """Return the master of minion, the first one if it is unknown"""
+        name = self.minions['masters'].get(minion)
+        return self.masters.get(name) or self.masters.masters[0]
+
+    def group_by_master(self, minions):
+        minion_masters = self.minions['masters']
+        grouped = {}
+        for minion in minions:
+            name = minion_masters.get(minion, self.masters.masters[0].name)
+            grouped.setdefault(name, []).append(minion)
+        return grouped
+
+    def cmd_list(self, minions, fun, timeout=None, *args):
+        """Run fun on a list of minions, one publish per master and all
+        masters concurrently.
+        """
+        results = {}
+        grouped = self.group_by_master(minions)
+        for ret in self.masters.query(lambda master: master.cmd(
+                grouped[master.name], fun, args, timeout, 'list'), grouped).values():
+            results.update(ret)
+        return results
+
+    def master_latencies(self):
+        return self.masters.latency_report()
+
+    def cache_stats(self):
+        """Return hits, misses and size of the cache of this process"""
+        return self.cache.stats()
 
     def get_minion_status(self, minion_name):
         if minion_name in self.minions["up"]:
@@ -72,50 +178,437 @@ class SaltStackClient(object):
         else:
             return "Bad minion_name"
 
-    def _reload_roles(self):
-        self._minions_roles = {}
-        self._roles_minions = {}
+    @memoize(ttl=60)
+    def _load_roles(self):
+        minions_roles = {}
+        roles_minions = {}
+
+        if not self.minions["up"]:
+            return minions_roles, roles_minions
 
+        # Fetch roles of all up minions in one publish per master
+        roles = self.cmd_list(self.minions["up"], 'grains.get', None, 'roles')
         for minion in self.minions["up"]:
-            roles = self.local.cmd(minion, 'grains.get', ['roles'])[minion]
-            self._minions_roles[minion] = roles
-            for role in roles:
-                self._roles_minions.setdefault(role, []).append(minion)
+            minion_roles = roles.get(minion) or []
+            minions_roles[minion] = minion_roles
+            for role in minion_roles:
+                roles_minions.setdefault(role, []).append(minion)
+        return minions_roles, roles_minions
 
     def minions_roles(self):
-        self._reload_roles()
-        return self._minions_roles
+        return self._load_roles()[0]
 
     def roles_minions(self):
-        self._reload_roles()
-        return self._roles_minions
+        return self._load_roles()[1]
+
+    def wait_for_minion(self, minion, timeout=120, interval=0.5,
+                        max_interval=10, ping_timeout=2):
+        """Poll test.ping on minion with exponential backoff until it answers
+        or timeout seconds are elapsed. Return True if the minion answered.
+        """
+        deadline = time() + timeout
+        while True:
+            if self.master_of(minion).cmd(minion, 'test.ping', timeout=ping_timeout).get(minion):
+                # Presence has changed, reload it on next access
+                self.cache.invalidate('minions')
+                return True
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            sleep(min(interval, remaining))
+            interval = min(interval * 2, max_interval)
+
+    @memoize(ttl=300)
+    def versions(self, minions=None):
+        """Return salt version of up minions, fetched in one publish per
+        master
+        """
+        if minions is None:
+            minions = self.minions['up']
+        if not minions:
+            return {}
+        return self.cmd_list(minions, 'test.version')
+
+    @memoize(ttl=10)
+    def get_sync_status(self, minion):
+        jobs = self.get_multiple_job_status(minion, "state_hightest_test", max=1)
+        if not jobs:
+            return 'none'
+        if jobs[0].get('summary'):
+            return jobs[0]['summary']['status']
+        if not jobs[0].get('return'):
+            return 'running'
+        return get_return_status(jobs[0]['return'])
+
+    def build_index(self):
+        """Rebuild the fleet index from presence, cached grains, roles,
+        versions and latest highstate test jobs.
+        """
+        index = FleetIndex()
+        minions = self.minions
+        known_minions = set(minions['up'] + minions['down'])
+        for status in ('up', 'down'):
+            for minion in minions[status]:
+                index.update(minion, 'status', status)
+        for minion, master in minions['masters'].items():
+            index.update(minion, 'master', master)
+
+        # Minions of masters which did not answer keep what was known of them
+        unreachable = set(minions['unreachable'])
+        for minion, attributes in self.index.attributes.items():
+            if minion in known_minions or not attributes.get('master', set()) & unreachable:
+                continue
+            known_minions.add(minion)
+            index.update(minion, 'status', 'unknown')
+            for attribute in ('master', 'role', 'version'):
+                if attribute in attributes:
+                    index.update(minion, attribute, list(attributes[attribute]))
+
+        for doc in self.fleet_db['grains'].find():
+            if doc['_id'] not in known_minions:
+                continue
+            for grain, value in unescape_keys(doc['data']).items():
+                if is_indexable(value):
+                    index.update(doc['_id'], grain, value)
+
+        for minion, roles in self.minions_roles().items():
+            index.update(minion, 'role', roles)
+        for minion, version in self.versions().items():
+            index.update(minion, 'version', version)
+
+        # Latest highstate test status of every minion in one query
+        sync_states = dict((doc['_id'], doc) for doc in
+            self.fleet_db['sync_state'].find({'_id': {'$in': list(known_minions)}}))
+        for minion in known_minions:
+            index.update(minion, 'sync', sync_status_of(sync_states.get(minion)))
+
+        self.index = index
+        self._index_time = time()
+
+    def get_index(self, max_age=60):
+        if self._index_time is None or time() - self._index_time > max_age:
+            self.build_index()
+        return self.index
+
+    def query(self, query, max_age=60):
+        """Return minions matching a query like 'role=web sync=failed'.
+        Attributes are status, master, role, version, sync and cached grains.
+        """
+        criteria = parse_query(query)
+        return self.get_index(max_age).query(criteria)
+
+    def refresh_snapshot(self, kind, timeout=None):
+        """Fetch grains or pillar of the whole fleet in one publish and store
+        them in Mongo. Only minions whose data hash changed are written, their
+        names are returned.
+        """
+        collection = self.fleet_db[kind]
+        known_hashes = dict((doc['_id'], doc['hash'])
+            for doc in collection.find({}, {'hash': 1}))
+
+        changed = []
+        results, answered = self.cmd_all('*', SNAPSHOT_FUNCTIONS[kind], timeout)
+        for minion, data in results.items():
+            data_hash = sha1(json.dumps(data, sort_keys=True, default=str)).hexdigest()
+            if known_hashes.get(minion) == data_hash:
+                continue
+            collection.update({'_id': minion}, {'_id': minion, 'hash': data_hash,
+                'data': escape_keys(data), 'updated': datetime.utcnow()}, upsert=True)
+            changed.append(minion)
+
+        # Forget minions whose key was deleted, only when every master has
+        # answered, minions of a slow master are not known to be gone
+        minions = self.minions
+        everyone = set(master.name for master in self.masters.masters)
+        if answered == everyone and not minions['unreachable']:
+            known_minions = set(results) | set(minions['up'] + minions['down'])
+            collection.remove({'_id': {'$nin': list(known_minions)}})
+            # They must not be counted in sync health any more either
+            self.fleet_db['sync_state'].remove({'_id': {'$nin': list(known_minions)}})
+        return sorted(changed)
+
+    def get_snapshot(self, kind, minion):
+        doc = self.fleet_db[kind].find_one({'_id': minion})
+        if doc:
+            doc['data'] = unescape_keys(doc['data'])
+        return doc
+
+    def search_snapshot(self, kind, key=None, value=None, fields=None):
+        """Return cached grains or pillar of minions having key, or having key
+        equal to value. Only fields are loaded from data when given.
+        """
+        query = {}
+        if key and value is not None:
+            values = [value]
+            if value.isdigit():
+                values.append(int(value))
+            query['data.' + key] = {'$in': values}
+        elif key:
+            query['data.' + key] = {'$exists': True}
+
+        projection = {'updated': 1}
+        for field in (fields or []):
+            projection['data.' + field] = 1
+
+        docs = list(self.fleet_db[kind].find(query, projection).sort('_id'))
+        for doc in docs:
+            doc['data'] = unescape_keys(doc.get('data', {}))
+        return docs
 
     def get_job_id(self, minion, jid):
         return self.con[minion].find_one({'jid': jid})
 
+    @memoize(ttl=10)
     def get_multiple_job_status(self, minion, key=None, max=5):
         query = {}
         if key:
             query['key'] = key
-        return list(self.db[minion].find(query).sort('_id', -1).limit(max))
+        # Summaries are enough here, never load encoded returns
+        jobs = list(self.db[minion].find(query, {'return_blob': 0, 'timings': 0})
+            .sort('_id', -1).limit(max))
+        for job in jobs:
+            if 'return' in job:
+                # Not ingested yet, summarize it without rewriting storage
+                job['summary'] = summarize_return(job.pop('return'))
+        return jobs
+
+    def job_landed(self, minion, job):
+        """Called once for each job when its return is ingested"""
+        if job.get('key') == "state_hightest_test":
+            record_sync_health(self.fleet_db, minion, job['_id'],
+                job['summary']['status'])
+
+    def get_timings(self, minion, key=None, runs=10):
+        """Return state timings of the latest runs of minion, newest first.
+        Jobs encoded before timings were extracted get them from their blob.
+        """
+        query = {'$or': [{'timings': {'$exists': True}},
+                         {'return_blob': {'$exists': True}}]}
+        if key:
+            query['key'] = key
+
+        collection = self.db[minion]
+        result = []
+        for job in collection.find(query, {'timings': 1}).sort('_id', -1).limit(runs):
+            if 'timings' not in job:
+                return_blob = collection.find_one({'_id': job['_id']},
+                    {'return_blob': 1})['return_blob']
+                job['timings'] = extract_timings(decode_return(return_blob))
+                collection.update({'_id': job['_id']},
+                    {'$set': {'timings': job['timings']}})
+            if job['timings']:
+                result.append(job['timings'])
+        return result
+
+    def profile(self, minions, key=None, runs=10, top=20):
+        """Profile state durations of the latest runs of minions"""
+        minions_runs = dict((minion, self.get_timings(minion, key, runs))
+                            for minion in minions)
+        return profile_timings(minions_runs, top)
+
+    def get_job_return(self, minion, jid):
+        job = self.get_job_status(minion, jid)
+        if job is None:
+            raise ValueError("Unknown job %s on minion %s" % (jid, minion))
+        if 'return' not in job:
+            raise ValueError("Job %s on minion %s is running or compacted" % (jid, minion))
+        return job['return']
+
+    def latest_jids(self, minion, key="state_hightest_test", count=2):
+        """Return jids of the latest finished jobs of minion, newest first"""
+        jobs = self.get_multiple_job_status(minion, key, max=count * 5)
+        return [job['jid'] for job in jobs if job.get('summary')][:count]
+
+    def diff_jobs(self, minion, old_jid, new_jid):
+        return diff_returns(self.get_job_return(minion, old_jid),
+                            self.get_job_return(minion, new_jid))
+
+    def compare_minions(self, minions, key="state_hightest_test"):
+        """Compare the latest finished job of key on each of minions"""
+        minions_returns = {}
+        for minion in minions:
+            jids = self.latest_jids(minion, key, count=1)
+            if jids:
+                try:
+                    minions_returns[minion] = self.get_job_return(minion, jids[0])
+                except ValueError:
+                    continue
+        return compare_returns(minions_returns)
+
+    def select_minions(self, role=None, patterns=None):
+        """Return known minions having role and matching any of patterns"""
+        if role:
+            minions = self.roles_minions().get(role, [])
+        else:
+            minions = self.minions['up'] + self.minions['down']
+        if patterns:
+            minions = [minion for minion in minions
+                       if any(fnmatch(minion, pattern) for pattern in patterns)]
+        return sorted(minions)
+
+    def export(self, kind, role=None, patterns=None, key=None, since=None):
+        """Return a generator of export rows of kind, jobs and states are read
+        from mongo cursors so exporting the whole history uses constant
+        memory.
+        """
+        if kind == 'presence':
+            return self.export_presence(self.select_minions(role, patterns))
+
+        if role:
+            minions = self.select_minions(role, patterns)
+        else:
+            # Removed minions still have their history stored
+            minions = sorted(name for name in self.db.collection_names()
+                             if not name.startswith('system.') and
+                             (not patterns or any(fnmatch(name, pattern)
+                                                  for pattern in patterns)))
+        if kind == 'jobs':
+            return export_jobs(self.db, minions, key, since)
+        if kind == 'states':
+            return export_states(self.db, minions, key, since)
+        raise ValueError("Unknown export kind %s" % kind)
 
+    def export_presence(self, minions):
+        minions_roles = self.minions_roles()
+        sync_states = dict((doc['_id'], doc) for doc in
+            self.fleet_db['sync_state'].find({'_id': {'$in': minions}}))
+        for minion in minions:
+            sync_state = sync_states.get(minion, {})
+            yield {'minion': minion, 'presence': self.get_minion_status(minion),
+                   'roles': minions_roles.get(minion, []),
+                   'sync_status': sync_state.get('status'),
+                   'sync_time': sync_state['job_id'].generation_time.isoformat()
+                                if 'job_id' in sync_state else None}
+
+    def get_sync_health(self, resolution='hour', limit=168):
+        """Return fleet sync health points, oldest first"""
+        points = self.fleet_db['sync_health'].find({'resolution': resolution},
+            {'_id': 0, 'resolution': 0}).sort('time', -1).limit(limit)
+        return list(reversed(list(points)))
+
+    # Never memoized, decoded returns can weigh megabytes each
     def get_job_status(self, minion, jid, key=None):
         query = {'jid': jid}
         if key:
             query['key'] = key
-        return self.db[minion].find_one(query)
+        job = self.db[minion].find_one(query)
+        if job and 'return_blob' in job:
+            job['return'] = decode_return(job.pop('return_blob'))
+        return job
 
     def run_job(self, minion, fun, key=None, *args, **kwargs):
-        result = self.local.run_job(minion, fun,
-            timeout=99999999999999, ret='nova_mongo_return', arg=args, kwarg=kwargs)
+        jid = self.master_of(minion).run_job(minion, fun, args, kwargs,
+            ret='nova_mongo_return')
         if key is None:
             key = fun
-        self.db[minion].insert({'jid': result['jid'], 'key': key})
-        return result['jid']
+        job_id = self.db[minion].insert({'jid': jid, 'key': key})
+        if key == "state_hightest_test":
+            self.index.update(minion, 'sync', 'running')
+            # Keeps the minion running when the index is rebuilt
+            self.fleet_db['sync_state'].update({'_id': minion},
+                {'$set': {'running_job_id': job_id}}, upsert=True)
+
+        self.cache.invalidate('get_multiple_job_status')
+        self.cache.invalidate('get_sync_status')
+        return jid
+
+    def start_deployment(self, target):
+        deployment = {'target': target, 'status': 'running',
+                      'started': datetime.utcnow(), 'minions': []}
+        return self.fleet_db['deployments'].insert(deployment)
+
+    def record_deployment_minion(self, deployment_id, minion_result):
+        """Append the result of a minion, with its roles and per phase
+        outcome and duration, to a running deployment.
+        """
+        self.fleet_db['deployments'].update({'_id': deployment_id},
+            {'$push': {'minions': minion_result}})
+
+    def finish_deployment(self, deployment_id, success):
+        """Close a deployment and fold it into the per day and per role
+        rollups, so history pages never scan raw deployments.
+        """
+        finished = datetime.utcnow()
+        status = 'success' if success else 'failed'
+        deployments = self.fleet_db['deployments']
+        deployment = deployments.find_one({'_id': deployment_id})
+        duration = (finished - deployment['started']).total_seconds()
+        deployments.update({'_id': deployment_id}, {'$set': {
+            'status': status, 'finished': finished, 'duration': duration}})
+
+        rollups = self.fleet_db['deployment_rollups']
+        rollups.ensure_index([('kind', 1), ('value', -1)])
+
+        day = deployment['started'].strftime('%Y-%m-%d')
+        rollups.update({'_id': 'day:' + day},
+            {'$set': {'kind': 'day', 'value': day},
+             '$inc': {'runs': 1, status: 1, 'duration': duration}}, upsert=True)
+
+        for minion_result in deployment['minions']:
+            minion_status = 'success' if minion_result['success'] else 'failed'
+            for role in minion_result['roles']:
+                rollups.update({'_id': 'role:' + role},
+                    {'$set': {'kind': 'role', 'value': role},
+                     '$inc': {'runs': 1, minion_status: 1,
+                              'duration': minion_result['duration']}}, upsert=True)
+
+    def get_deployments(self, limit=50):
+        return list(self.fleet_db['deployments'].find().sort('_id', -1).limit(limit))
+
+    def get_deployment_rollups(self, kind, limit=30):
+        rollups = self.fleet_db['deployment_rollups'].find({'kind': kind},
+            {'_id': 0}).sort('value', -1)
+        if limit:
+            rollups = rollups.limit(limit)
+        return list(rollups)
+
+    def ingest_jobs(self):
+        """Encode returns landed since the last ingestion, return their count"""
+        return ingest_jobs(self.db, self.job_landed)
+
+    def compact_jobs(self, keep=20, downsample_after=90):
+        stats = compact_jobs(self.db, keep, downsample_after, self.job_landed)
+        self.cache.invalidate('get_multiple_job_status')
+        return stats
 
     def cmd(self, target, fun, timeout=None, *args, **kwargs):
-        return self.local.cmd(target, fun, arg=args, timeout=timeout,
-            kwarg=kwargs)
+        """Run fun on target, on the master of target if it is a known minion
+        and on all masters concurrently otherwise.
+        """
+        if isinstance(target, basestring) and target in self.minions['masters']:
+            return self.master_of(target).cmd(target, fun, args, timeout, kwarg=kwargs)
+        return self.cmd_all(target, fun, timeout, args, kwargs)[0]
+
+    def cmd_all(self, target, fun, timeout=None, args=(), kwargs=None):
+        """Run fun on target on all masters concurrently. Return the merged
+        results and names of masters which answered.
+
+        Salt takes a little longer than its timeout to gather returns, so
+        masters get the pool timeout on top of it to answer. Without salt
+        timeout, the master configured one is used, a hung master is never
+        waited for forever.
+        """
+        if timeout is None:
+            timeout = self.salt_timeout
+        answers = self.masters.query(lambda master: master.cmd(target, fun,
+            args, timeout, kwarg=kwargs), timeout=timeout + self.masters.timeout)
+        results = {}
+        for ret in answers.values():
+            results.update(ret)
+        return results, set(answers)
 
     def cmd_iter(self, target, fun, *args, **kwargs):
-        return self.local.cmd_iter(target, fun, arg=args, kwarg=kwargs)
+        calls = dict((master.name, lambda master: master.cmd_iter(target, fun,
+            args, kwarg=kwargs)) for master in self.masters.masters)
+        for minion, result in self.masters.iter_query(calls):
+            yield {minion: {'ret': result}}
+
+    def cmd_list_iter(self, minions, fun, timeout=None, *args):
+        """Run fun on a list of minions with a single publish per master, yield
+        (minion, result) as soon as each minion returns.
+        """
+        grouped = self.group_by_master(minions)
+        calls = dict((name, lambda master: master.cmd_iter(grouped[master.name],
+            fun, args, timeout, 'list')) for name in grouped)
+        return self.masters.iter_query(calls)
@@ -0,0 +1,150 @@
+import csv
+import json
+
+from cStringIO import StringIO
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from jobs import summarize_return, decode_return, parse_duration
+
+
+EXPORT_FIELDS = {
+    'jobs': ['minion', 'jid', 'key', 'time', 'status', 'total', 'failed',
+             'changes', 'changed_states'],
+    'states': ['minion', 'jid', 'key', 'time', 'state', 'sls', 'result',
+               'changed', 'duration', 'comment'],
+    'presence': ['minion', 'presence', 'roles', 'sync_status', 'sync_time'],
+}
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+# Jobs fetched per round-trip to mongo and bytes written per output chunk
+EXPORT_BATCH_SIZE = 200
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+
+def parse_since(value):
+    """Return the ObjectId matching a YYYY-MM-DD date, to be compared with
+    job ids.
+    """
+    return ObjectId.from_datetime(datetime.strptime(value, '%Y-%m-%d'))
+
+
+def iter_jobs(db, minions, key=None, since=None, projection=None,
+              batch_size=EXPORT_BATCH_SIZE):
+    """Yield (minion, job) for jobs of minions, oldest first, holding at most
+    one batch of jobs in memory.
+    """
+    query = {}
+    if key:
+        query['key'] = key
+    if since:
+        query['_id'] = {'$gte': since}
+    for minion in minions:
+        cursor = db[minion].find(query, projection).sort('_id', 1).batch_size(batch_size)
+        for job in cursor:
+            yield minion, job
+
+
+def job_row(minion, job):
+    return {'minion': minion, 'jid': job.get('jid'), 'key': job.get('key'),
+            'time': job['_id'].generation_time.isoformat()}
+
+
+def export_jobs(db, minions, key=None, since=None):
+    """Yield one row per job with its summary, jobs whose return has not been
+    encoded yet are summarized on the fly.
+    """
+    for minion, job in iter_jobs(db, minions, key, since,
+                                 {'return_blob': 0, 'timings': 0}):
+        row = job_row(minion, job)
+        if 'return' in job:
+            summary = summarize_return(job['return'])
+        else:
+            summary = job.get('summary', {'status': 'running'})
+        row.update((field, summary.get(field)) for field in EXPORT_FIELDS['jobs']
+                   if field not in row)
+        yield row
+
+
+def export_states(db, minions, key=None, since=None):
+    """Yield one row per state of every job whose full return is still
+    stored, compacted jobs only have their summary left.
+    """
+    projection = {'jid': 1, 'key': 1, 'return': 1, 'return_blob': 1}
+    for minion, job in iter_jobs(db, minions, key, since, projection):
+        if 'return' in job:
+            job_return = job['return']
+        elif 'return_blob' in job:
+            job_return = decode_return(job['return_blob'])
+        else:
+            continue
+        if not isinstance(job_return, dict):
+            continue
+
+        for state_id, state in sorted(job_return.items()):
+            if not isinstance(state, dict):
+                continue
+            row = job_row(minion, job)
+            row.update({'state': state_id, 'sls': state.get('__sls__'),
+                        'result': state.get('result'),
+                        'changed': bool(state.get('changes')),
+                        'duration': parse_duration(state.get('duration')),
+                        'comment': state.get('comment')})
+            yield row
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        value = ' '.join(unicode(item) for item in value)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def chunked(lines, size=EXPORT_CHUNK_SIZE):
+    """Join lines into chunks of about size bytes, so a large export is not
+    written one tiny line at a time.
+    """
+    chunk = []
+    length = 0
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def to_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, default=unicode) + '\n'
+
+
+def to_csv(rows, fields):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow([csv_value(row.get(field)) for field in fields])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    # Header only exports still get their header
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def serialize(rows, kind, fmt):
+    """Return a generator of output chunks of rows in fmt"""
+    if fmt == 'csv':
+        lines = to_csv(rows, EXPORT_FIELDS[kind])
+    elif fmt == 'ndjson':
+        lines = to_ndjson(rows)
+    else:
+        raise ValueError("Unknown export format %s" % fmt)
+    return chunked(lines)
@@ -0,0 +1,75 @@
+class FleetIndex(object):
+    """In-memory inverted index of minions by attribute values.
+
+    Each (attribute, value) pair maps to the set of minions having it, so a
+    multi-attribute query is a handful of set intersections whatever the
+    fleet size.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.attributes = {}
+
+    def update(self, minion, attribute, values):
+        """Replace values of a minion attribute, values can be a single value
+        or a list of values.
+        """
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        values = set(unicode(value) for value in values)
+
+        minion_attributes = self.attributes.setdefault(minion, {})
+        for value in minion_attributes.get(attribute, set()) - values:
+            self._discard(minion, attribute, value)
+        for value in values:
+            self.postings.setdefault((attribute, value), set()).add(minion)
+        minion_attributes[attribute] = values
+
+    def remove(self, minion):
+        for attribute, values in self.attributes.pop(minion, {}).items():
+            for value in values:
+                self._discard(minion, attribute, value)
+
+    def _discard(self, minion, attribute, value):
+        postings = self.postings.get((attribute, value))
+        if postings is None:
+            return
+        postings.discard(minion)
+        if not postings:
+            del self.postings[(attribute, value)]
+
+    def query(self, criteria):
+        """Return sorted minions matching all criteria, a list of
+        (attribute, values) pairs matched when the minion has any of values.
+        """
+        matches = []
+        for attribute, values in criteria:
+            matching = set()
+            for value in values:
+                matching |= self.postings.get((attribute, value), set())
+            matches.append(matching)
+
+        if not matches:
+            return sorted(self.attributes)
+
+        # Intersect from the most selective criterion
+        matches.sort(key=len)
+        result = set(matches[0])
+        for matching in matches[1:]:
+            if not result:
+                break
+            result &= matching
+        return sorted(result)
+
+
+def parse_query(query):
+    """Parse a query like 'role=web,db version=2014.1.0 sync=failed' into a
+    list of (attribute, values) pairs.
+    """
+    criteria = []
+    for term in query.split():
+        if '=' not in term:
+            raise ValueError("Invalid query term %r, expected attribute=value" % term)
+        attribute, values = term.split('=', 1)
+        criteria.append((attribute, values.split(',')))
+    return criteria
@@ -0,0 +1,368 @@
+import zlib
+import heapq
+
+from datetime import datetime, timedelta
+
+from bson import BSON
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+
+SYNC_HEALTH_FIELDS = {'success': 'ok', 'changes': 'changed', 'failed': 'failed'}
+HOURLY_HEALTH_RETENTION = timedelta(days=7)
+
+
+def get_return_status(job_return):
+    """Summarize a highstate return as success, changes or failed"""
+    if not isinstance(job_return, dict):
+        return 'failed'
+    results = [state.get('result') for state in job_return.values()]
+    if False in results:
+        return 'failed'
+    if None in results:
+        return 'changes'
+    return 'success'
+
+
+def summarize_return(job_return):
+    """Reduce a highstate return to its status, counts and changed states"""
+    summary = {'status': get_return_status(job_return), 'total': 0,
+               'failed': 0, 'changes': 0, 'changed_states': []}
+    if not isinstance(job_return, dict):
+        return summary
+
+    for state_id, state in job_return.items():
+        summary['total'] += 1
+        if state.get('result') is False:
+            summary['failed'] += 1
+        if state.get('changes'):
+            summary['changes'] += 1
+            summary['changed_states'].append(state_id)
+    summary['changed_states'].sort()
+    return summary
+
+
+def parse_duration(duration):
+    """Return a state duration in milliseconds, salt gives either a number
+    or a string like '12.3 ms'.
+    """
+    if isinstance(duration, basestring):
+        duration = duration.split()[0] if duration.split() else None
+    try:
+        return float(duration)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def extract_timings(job_return):
+    """Return [state_id, run_num, duration, sls] of every state of a
+    highstate return, they are kept when the return itself is compacted.
+    """
+    if not isinstance(job_return, dict):
+        return []
+    return [[state_id, state.get('__run_num__', 0),
+             parse_duration(state.get('duration')), state.get('__sls__')]
+            for state_id, state in job_return.items()
+            if isinstance(state, dict)]
+
+
+def profile_timings(minions_runs, top=20, regression_factor=1.5,
+                    regression_min=1000):
+    """Aggregate state timings of several minions.
+
+    minions_runs maps each minion to the timings of its runs, newest first.
+    Return the slowest states and SLS files by total time, the states of
+    the newest runs slower than regression_factor times (and at least
+    regression_min ms more than) their previous mean, and for each minion
+    its total time and slowest states in execution order with the elapsed
+    time at which they ended.
+    """
+    states = {}
+    sls_files = {}
+    regressions = []
+    critical_paths = {}
+
+    for minion, runs in minions_runs.items():
+        if not runs:
+            continue
+
+        history = {}
+        for timings in runs:
+            for state_id, run_num, duration, sls in timings:
+                for stats, name in ((states, state_id), (sls_files, sls)):
+                    if name is None:
+                        continue
+                    entry = stats.setdefault(name, {'name': name, 'runs': 0,
+                        'total': 0.0, 'max': 0.0, 'minions': set()})
+                    entry['runs'] += 1
+                    entry['total'] += duration
+                    entry['max'] = max(entry['max'], duration)
+                    entry['minions'].add(minion)
+                history.setdefault(state_id, []).append(duration)
+
+        # Newest run against the mean of the previous ones
+        for state_id, run_num, duration, sls in runs[0]:
+            previous = history[state_id][1:]
+            if not previous:
+                continue
+            mean = sum(previous) / len(previous)
+            if duration > mean * regression_factor and duration - mean > regression_min:
+                regressions.append({'minion': minion, 'name': state_id,
+                    'duration': duration, 'previous_mean': mean})
+
+        # States run one after the other, elapsed time is a running sum
+        elapsed = 0.0
+        path = []
+        for state_id, run_num, duration, sls in sorted(runs[0], key=lambda t: t[1]):
+            elapsed += duration
+            path.append({'run_num': run_num, 'name': state_id, 'sls': sls,
+                         'duration': duration, 'elapsed': elapsed})
+        durations = sorted((step['duration'] for step in path), reverse=True)
+        threshold = durations[:top][-1] if durations else 0
+        critical_paths[minion] = {'total': elapsed,
+            'steps': [step for step in path if step['duration'] >= threshold]}
+
+    def slowest(stats):
+        result = sorted(stats.values(), key=lambda entry: -entry['total'])[:top]
+        for entry in result:
+            entry['mean'] = entry['total'] / entry['runs']
+            entry['minions'] = len(entry['minions'])
+        return result
+
+    regressions.sort(key=lambda r: r['previous_mean'] - r['duration'])
+    return {'states': slowest(states), 'sls': slowest(sls_files),
+            'regressions': regressions[:top], 'critical_paths': critical_paths}
+
+
+def diff_returns(old_return, new_return):
+    """Return states added, removed, whose result changed or whose comment
+    only changed between two highstate returns, in one pass over each.
+    """
+    if not isinstance(old_return, dict):
+        old_return = {}
+    if not isinstance(new_return, dict):
+        new_return = {}
+
+    diff = {'added': [], 'removed': [], 'status_changed': [], 'comment_changed': []}
+    for state_id, new_state in new_return.items():
+        old_state = old_return.get(state_id)
+        if old_state is None:
+            diff['added'].append({'name': state_id, 'new': new_state.get('result'),
+                                  'new_comment': new_state.get('comment')})
+            continue
+
+        change = {'name': state_id,
+                  'old': old_state.get('result'), 'new': new_state.get('result'),
+                  'old_comment': old_state.get('comment'),
+                  'new_comment': new_state.get('comment')}
+        if change['old'] != change['new']:
+            diff['status_changed'].append(change)
+        elif change['old_comment'] != change['new_comment']:
+            diff['comment_changed'].append(change)
+
+    for state_id, old_state in old_return.items():
+        if state_id not in new_return:
+            diff['removed'].append({'name': state_id, 'old': old_state.get('result'),
+                                    'old_comment': old_state.get('comment')})
+
+    for changes in diff.values():
+        changes.sort(key=lambda change: change['name'])
+    return diff
+
+
+def compare_returns(minions_returns):
+    """Return states whose result differs between minions, or which are
+    missing on some of them, as {state_id: {minion: result or 'missing'}}.
+    """
+    states = {}
+    for minion, job_return in minions_returns.items():
+        if not isinstance(job_return, dict):
+            continue
+        for state_id, state in job_return.items():
+            states.setdefault(state_id, {})[minion] = state.get('result')
+
+    minions = sorted(minions_returns)
+    differing = {}
+    for state_id, results in states.items():
+        if len(results) != len(minions) or len(set(results.values())) > 1:
+            differing[state_id] = dict((minion, results.get(minion, 'missing'))
+                                       for minion in minions)
+    return differing
+
+
+def encode_return(job_return):
+    return Binary(zlib.compress(BSON.encode({'return': job_return})))
+
+
+def decode_return(return_blob):
+    return BSON(zlib.decompress(return_blob)).decode()['return']
+
+
+def encode_job(collection, job):
+    """Replace the raw return of job by a compressed blob and a summary, in
+    collection and in job itself which is left without return.
+    """
+    job_return = job.pop('return')
+    job['summary'] = summarize_return(job_return)
+    collection.update({'_id': job['_id']},
+        {'$set': {'summary': job['summary'],
+                  'timings': extract_timings(job_return),
+                  'return_blob': encode_return(job_return)},
+         '$unset': {'return': 1}})
+
+
+def sync_health_counts(fleet_db):
+    """Count minions by the status of their latest ingested highstate test"""
+    sync_state = fleet_db['sync_state']
+    sync_state.ensure_index('status')
+    return dict((field, sync_state.find({'status': status}).count())
+                for status, field in SYNC_HEALTH_FIELDS.items())
+
+
+def record_sync_health(fleet_db, minion, job_id, status):
+    """Update the fleet sync health time series with the latest highstate
+    test status of minion.
+
+    Counts of ok, changed and failed minions are taken from sync_state, so
+    forgotten minions drop out of them, and written into the hour and day
+    buckets of the job creation time. Jobs are ingested oldest first, so a
+    bucket never counts results of later jobs. Hour buckets are kept for a
+    week, day buckets forever.
+    """
+    try:
+        fleet_db['sync_state'].find_and_modify(
+            {'_id': minion, '$or': [{'job_id': {'$lt': job_id}},
+                                    {'job_id': {'$exists': False}}]},
+            {'$set': {'job_id': job_id, 'status': status}}, upsert=True)
+    except DuplicateKeyError:
+        # A more recent job of this minion has already landed
+        return
+
+    health = fleet_db['sync_health']
+    counts = sync_health_counts(fleet_db)
+
+    now = datetime.utcnow()
+    landed = job_id.generation_time.replace(tzinfo=None)
+    buckets = [('hour', landed.replace(minute=0, second=0, microsecond=0)),
+               ('day', landed.replace(hour=0, minute=0, second=0, microsecond=0))]
+    for resolution, bucket in buckets:
+        if resolution == 'hour' and bucket < now - HOURLY_HEALTH_RETENTION:
+            continue
+        point = dict(counts, resolution=resolution, time=bucket)
+        health.update({'_id': '%s:%s' % (resolution, bucket.isoformat())},
+            {'$set': point}, upsert=True)
+
+    health.remove({'resolution': 'hour',
+                   'time': {'$lt': now - HOURLY_HEALTH_RETENTION}})
+
+
+def ingest_collection(collection, on_encode=None):
+    """Encode every raw return of a minion collection, on_encode is called
+    with each encoded job. Return the number of encoded jobs.
+    """
+    encoded = 0
+    for job in collection.find({'return': {'$exists': True}}):
+        encode_job(collection, job)
+        encoded += 1
+        if on_encode:
+            on_encode(collection.name, job)
+    return encoded
+
+
+def raw_jobs(collection):
+    """Yield (job id, collection name, job) of jobs whose raw return is
+    still stored, oldest first.
+    """
+    for job in collection.find({'return': {'$exists': True}}).sort('_id', 1):
+        yield job['_id'], collection.name, job
+
+
+def ingest_jobs(db, on_encode=None):
+    """Encode raw returns of every minion collection of db, return the
+    number of encoded jobs. Jobs of all minions are ingested together oldest
+    first, on_encode sees them in the order they were run.
+    """
+    encoded = 0
+    for _, collection_name, job in heapq.merge(*[raw_jobs(db[collection_name])
+            for collection_name in db.collection_names()
+            if not collection_name.startswith('system.')]):
+        encode_job(db[collection_name], job)
+        encoded += 1
+        if on_encode:
+            on_encode(collection_name, job)
+    return encoded
+
+
+def compact_collection(collection, keep=20, downsample_after=90, on_encode=None):
+    """Compact jobs of one minion collection.
+
+    Only the `keep` latest jobs of each key keep their full return, encoded
+    if not done yet, older returns are replaced by their summary. Jobs older
+    than downsample_after days are downsampled to the latest job of each key
+    and day. on_encode is called with each job whose return gets encoded.
+    Return (compacted, encoded, removed) jobs counts.
+    """
+    collection.ensure_index([('key', 1), ('_id', -1)])
+
+    compacted = 0
+    kept_ids = set()
+    for key in collection.distinct('key'):
+        jobs = collection.find({'key': key}, {'_id': 1}).sort('_id', -1)
+        job_ids = [job['_id'] for job in jobs]
+        kept_ids.update(job_ids[:keep])
+        old_ids = job_ids[keep:]
+        if not old_ids:
+            continue
+
+        compacted += collection.find({'_id': {'$in': old_ids},
+            'return_blob': {'$exists': True}}).count()
+        collection.update({'_id': {'$in': old_ids}},
+            {'$unset': {'return_blob': 1}}, multi=True)
+
+        for job in collection.find({'_id': {'$in': old_ids}, 'return': {'$exists': True}}):
+            collection.update({'_id': job['_id']},
+                {'$set': {'summary': summarize_return(job['return'])},
+                 '$unset': {'return': 1}})
+            compacted += 1
+
+    encoded = ingest_collection(collection, on_encode)
+
+    cutoff = ObjectId.from_datetime(datetime.utcnow() - timedelta(days=downsample_after))
+    seen = set()
+    removed_ids = []
+    for job in collection.find({'_id': {'$lt': cutoff}}, {'key': 1}).sort('_id', -1):
+        day = (job.get('key'), job['_id'].generation_time.date())
+        # The latest jobs of each key are kept whatever their age
+        if job['_id'] in kept_ids:
+            seen.add(day)
+        elif day in seen:
+            removed_ids.append(job['_id'])
+        else:
+            seen.add(day)
+    if removed_ids:
+        collection.remove({'_id': {'$in': removed_ids}})
+
+    return compacted, encoded, len(removed_ids)
+
+
+def compact_jobs(db, keep=20, downsample_after=90, on_encode=None):
+    """Compact jobs of every minion collection of db, return counts of
+    compacted, encoded and removed jobs and the number of bytes reclaimed.
+    """
+    data_size = db.command('dbstats')['dataSize']
+
+    # Ingest across collections first, compacting one collection at a time
+    # would land jobs out of order
+    stats = {'compacted': 0, 'encoded': ingest_jobs(db, on_encode), 'removed': 0}
+    for collection_name in db.collection_names():
+        if collection_name.startswith('system.'):
+            continue
+        compacted, encoded, removed = compact_collection(db[collection_name],
+            keep, downsample_after, on_encode)
+        stats['compacted'] += compacted
+        stats['encoded'] += encoded
+        stats['removed'] += removed
+
+    stats['reclaimed'] = data_size - db.command('dbstats')['dataSize']
+    return stats
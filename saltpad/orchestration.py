@@ -0,0 +1,37 @@
+def role_tiers(dependencies):
+    """Return the tier of each role of a {role: [roles it depends on]} DAG,
+    roles without dependencies are in tier 0 and every other role is one tier
+    after its latest dependency. Raise ValueError on dependency cycles.
+    """
+    roles = set(dependencies)
+    for role_dependencies in dependencies.values():
+        roles.update(role_dependencies)
+
+    tiers = {}
+    remaining = roles
+    tier = 0
+    while remaining:
+        ready = set(role for role in remaining
+                    if all(dependency in tiers and tiers[dependency] < tier
+                           for dependency in dependencies.get(role, [])))
+        if not ready:
+            raise ValueError("Roles dependencies cycle between %s"
+                             % ", ".join(sorted(remaining)))
+        for role in ready:
+            tiers[role] = tier
+        remaining = remaining - ready
+        tier += 1
+    return tiers
+
+
+def minions_tiers(minions_roles, dependencies):
+    """Group minions into tiers to deploy one after the other, a minion goes
+    with its role of highest tier and minions without any role declared in
+    dependencies go in tier 0. Return a list of sorted lists of minions.
+    """
+    tiers = role_tiers(dependencies)
+    grouped = {}
+    for minion, roles in minions_roles.items():
+        tier = max([tiers.get(role, 0) for role in roles] or [0])
+        grouped.setdefault(tier, []).append(minion)
+    return [sorted(grouped[tier]) for tier in sorted(grouped)]
@@ -10,8 +10,12 @@ import operator
 from salt.output.highstate import _format_host, output
 
 from core import SaltStackClient
+from jobs import summarize_return
+from orchestration import minions_tiers
+from export import EXPORT_FIELDS, EXPORT_FORMATS, parse_since, serialize
+from config import ConfigStore
 
-from time import sleep
+from time import sleep, time
 from plumbum import cli, local, FG
 from clint.eng import join as eng_join
 from clint.textui import colored, puts, indent
@@ -51,7 +55,7 @@ def call(cmd):
 def bool_choice(message):
     try:
         return strtobool(raw_input(message).lower())
-    except ValueError:
+    except (ValueError, EOFError):
         return 0
 
 
@@ -99,12 +103,8 @@ class SaltPad(cli.Application):
     def __init__(self, *args, **kwargs):
         super(SaltPad, self).__init__(*args, **kwargs)
         self.config_file = expanduser("~/.saltpad.json")
-
-        if isfile(self.config_file):
-            with open(self.config_file) as f:
-                self.config = json.load(f)
-        else:
-            self.config = {}
+        self.config_store = ConfigStore(self.config_file)
+        self.config = self.config_store.load()
 
         self.client = SaltStackClient()
 
@@ -117,14 +117,17 @@ class SaltPad(cli.Application):
             self.help()
             return 1   # error exit code
 
-    def write_config_file(self):
-        with open(self.config_file, 'w') as f:
-            json.dump(self.config, f)
+    def update_config(self, section, entries):
+        self.config = self.config_store.update(section, entries)
 
 
 @SaltPad.subcommand("deploy")
 class Deploy(cli.Application):
 
+    tiered = cli.Flag("--tiered", help="Deploy minions tier by tier following "
+        "the role_dependencies config section, ie: {\"app\": [\"db\"]}, "
+        "minions of a tier concurrently")
+
     def main(self, project_name):
         # Deploy
         minions = self.parent.client.cmd(project_name, 'test.ping')
@@ -145,50 +148,177 @@ class Deploy(cli.Application):
 
         puts(colored.blue("Starting deployment on %s" % eng_join(minions.keys(), im_a_moron=True)))
 
+        client = self.parent.client
+        if self.tiered:
+            self.deploy_tiers(project_name, sorted(minions))
+            return
+
+        deployment_id = client.start_deployment(project_name)
+
+        # Whatever interrupts the deployment, it is closed as failed
+        success = False
+        try:
+            for minion in minions:
+                minion_result = self.deploy_minion(minion)
+                client.record_deployment_minion(deployment_id, minion_result)
+
+                if not minion_result['success']:
+                    sys.exit(1)
+            success = True
+        finally:
+            client.finish_deployment(deployment_id, success)
+
+        puts()
+        puts(colored.green("Deployment success on all minions!"))
+
+    def run_phase(self, minion, fun, *args):
+        """Run fun on minion and print its output. Return whether it succeeded
+        and the phase record stored in deployment history.
+        """
+        start = time()
+        results = self.parent.client.cmd(minion, fun, 9999999999, *args)
+        if minion not in results:
+            puts(colored.red("Minion %s did not return" % minion))
+            return False, {'success': False, 'duration': time() - start,
+                           'total': 0, 'failed': 0, 'changes': 0}
+        return self.report_phase(minion, results[minion], time() - start)
+
+    def report_phase(self, minion, result, duration):
+        x = _format_host(minion, result)
+        print x[0]
+        success = bool(parse_result(result))
+
+        summary = summarize_return(result)
+        return success, {'success': success, 'duration': duration,
+                         'total': summary['total'], 'failed': summary['failed'],
+                         'changes': summary['changes']}
+
+    def deploy_tiers(self, project_name, minions):
+        """Deploy minions tier by tier, every tier being healthy before the
+        next one starts.
+        """
+        client = self.parent.client
+        minions_roles = client.minions_roles()
+        try:
+            tiers = minions_tiers(dict((minion, minions_roles.get(minion, []))
+                                       for minion in minions),
+                                  self.parent.config.get('role_dependencies', {}))
+        except ValueError as e:
+            puts(colored.red("%s, abort!" % e))
+            sys.exit(1)
+
+        deployment_id = client.start_deployment(project_name)
+
+        # Whatever interrupts the deployment, it is closed as failed
+        success = False
+        try:
+            for tier_num, tier in enumerate(tiers):
+                puts(colored.blue("=" * 10))
+                puts(colored.blue("Tier %d: %s" % (tier_num, eng_join(tier, im_a_moron=True))))
+
+                tier_results = self.deploy_tier(tier, minions_roles)
+                for minion_result in tier_results:
+                    client.record_deployment_minion(deployment_id, minion_result)
+
+                failed = [minion_result['minion'] for minion_result in tier_results
+                          if not minion_result['success']]
+                if failed:
+                    puts()
+                    puts(colored.red("Tier %d has failed on %s, abort!"
+                                     % (tier_num, eng_join(failed, im_a_moron=True))))
+                    sys.exit(1)
+            success = True
+        finally:
+            client.finish_deployment(deployment_id, success)
+
+        puts()
+        puts(colored.green("Deployment success on all tiers!"))
+
+    def deploy_tier(self, minions, minions_roles):
+        """Run highstate then healthchecks on all minions of a tier at once,
+        return their results for deployment history.
+        """
+        results = dict((minion, {'minion': minion, 'roles': minions_roles.get(minion, []),
+                                 'duration': 0})
+                       for minion in minions)
+
+        puts(colored.blue("Execute state.highstate"))
+        healthy = self.run_tier_phase(minions, results, 'highstate', 'state.highstate')
+
+        if healthy:
+            puts(colored.blue("Starting healthchecks on %s" % eng_join(healthy, im_a_moron=True)))
+            healthy = self.run_tier_phase(healthy, results, 'healthcheck',
+                'state.top', 'healthcheck_top.sls')
+
         for minion in minions:
-            puts(colored.blue("=" * 10))
-            puts(colored.blue("Minion: %s" % minion))
-            puts(colored.blue("Roles: %s" % eng_join(self.parent.client.minions_roles()[minion], im_a_moron=True)))
+            results[minion]['success'] = minion in healthy
+        return [results[minion] for minion in minions]
+
+    def run_tier_phase(self, minions, results, phase, fun, *args):
+        """Run fun on minions with a single publish, reporting each minion as
+        soon as it returns. Return minions on which it succeeded.
+        """
+        start = time()
+        succeeded = []
+        for minion, result in self.parent.client.cmd_list_iter(minions, fun,
+                9999999999, *args):
+            success, results[minion][phase] = self.report_phase(minion, result,
+                time() - start)
+            results[minion]['duration'] += results[minion][phase]['duration']
+            if success:
+                succeeded.append(minion)
 
-            puts()
-            puts(colored.blue("Execute state.highstate"))
+        for minion in minions:
+            if phase not in results[minion]:
+                puts(colored.red("Minion %s did not return" % minion))
+                results[minion][phase] = {'success': False, 'duration': time() - start,
+                                          'total': 0, 'failed': 0, 'changes': 0}
+                results[minion]['duration'] += results[minion][phase]['duration']
+        return succeeded
+
+    def deploy_minion(self, minion):
+        """Run highstate then healthchecks on minion, return its result for
+        deployment history.
+        """
+        roles = self.parent.client.minions_roles().get(minion, [])
+        minion_result = {'minion': minion, 'roles': roles}
+        start = time()
+
+        puts(colored.blue("=" * 10))
+        puts(colored.blue("Minion: %s" % minion))
+        puts(colored.blue("Roles: %s" % eng_join(roles, im_a_moron=True)))
 
-            result = self.parent.client.cmd(minion, 'state.highstate',
-                timeout=9999999999)[minion]
-            x = _format_host(minion, result)
-            print x[0]
-            success = parse_result(result)
+        puts()
+        puts(colored.blue("Execute state.highstate"))
 
-            if not success:
-                puts()
-                puts(colored.red("Deployment has failed on %s minion, abort!"
-                                 % minion))
-                sys.exit(1)
+        success, minion_result['highstate'] = self.run_phase(minion, 'state.highstate')
 
+        if not success:
+            puts()
+            puts(colored.red("Deployment has failed on %s minion, abort!"
+                             % minion))
+        else:
             # Do orchestration
             # orchestration_result = self.parent.client.orchestrate(minion)
             # print "orchestration_result", orchestration_result
 
             # Call health-checks
             puts(colored.blue("Starting healthchecks on %s" % minion))
-            health_checks_result = self.parent.client.cmd(minion,
-                    'state.top', 9999999999, 'healthcheck_top.sls')[minion]
-            x = _format_host(minion, health_checks_result)
-            print x[0]
-            success = parse_result(health_checks_result)
+            success, minion_result['healthcheck'] = self.run_phase(minion,
+                'state.top', 'healthcheck_top.sls')
 
             if not success:
                 puts()
                 puts(colored.red("Healthchecks has failed on minion %s"
                                  % minion))
-                sys.exit(1)
             else:
                 puts()
                 puts(colored.green("Healthchecks success on minion %s"
                                    % minion))
 
-        puts()
-        puts(colored.green("Deployment success on all minions!"))
+        minion_result['success'] = success
+        minion_result['duration'] = time() - start
+        return minion_result
 
     def parse_result(self, result):
         success = 0
@@ -260,6 +390,222 @@ class Healthchecks(cli.Application):
                                    % minion))
 
 
+@SaltPad.subcommand("ingest_jobs")
+class IngestJobs(cli.Application):
+    """Encode landed job returns and update the fleet sync health, web views
+    only read jobs
+    """
+
+    interval = cli.SwitchAttr("--interval", int, default=0,
+        help="Run again every INTERVAL seconds instead of exiting")
+
+    def main(self):
+        while True:
+            ingested = self.parent.client.ingest_jobs()
+            puts(colored.blue("%d jobs ingested" % ingested))
+
+            if not self.interval:
+                break
+            sleep(self.interval)
+
+
+@SaltPad.subcommand("compact_jobs")
+class CompactJobs(cli.Application):
+    """Replace old jobs returns by their summary and downsample old history
+    """
+
+    keep = cli.SwitchAttr("--keep", int, default=20,
+        help="Number of latest jobs per minion and key keeping their full return")
+    downsample_after = cli.SwitchAttr("--downsample-after", int, default=90,
+        help="Keep only one job per key and day after this number of days")
+    interval = cli.SwitchAttr("--interval", int, default=0,
+        help="Run again every INTERVAL seconds instead of exiting")
+
+    def main(self):
+        while True:
+            stats = self.parent.client.compact_jobs(self.keep, self.downsample_after)
+            puts(colored.blue("{compacted} jobs compacted, {encoded} jobs encoded, "
+                "{removed} jobs removed, {reclaimed} bytes reclaimed".format(**stats)))
+
+            if not self.interval:
+                break
+            sleep(self.interval)
+
+
+@SaltPad.subcommand("profile")
+class Profile(cli.Application):
+    """Report slowest states, regressions and critical paths of highstate
+    runs stored for minions matching patterns
+    """
+
+    role = cli.SwitchAttr("--role", str, default=None, help="Only minions with this role")
+    key = cli.SwitchAttr("--key", str, default=None, help="Only jobs of this key, ie: state_hightest_test")
+    runs = cli.SwitchAttr("--runs", int, default=10, help="Number of latest runs per minion")
+    top = cli.SwitchAttr("--top", int, default=20, help="Number of states per section")
+
+    def main(self, *patterns):
+        client = self.parent.client
+        minions = client.select_minions(self.role, patterns)
+        if not minions:
+            puts(colored.red("No minions matching, abort!"))
+            sys.exit(1)
+
+        profile = client.profile(minions, self.key, self.runs, self.top)
+
+        for section, title in (('states', 'Slowest states'), ('sls', 'Slowest SLS files')):
+            puts(colored.blue(title))
+            with indent(2):
+                for entry in profile[section]:
+                    puts("{total:10.0f} ms total {mean:8.0f} ms mean {max:8.0f} ms max "
+                         "{runs:4} runs {minions:4} minions  {name}".format(**entry))
+
+        puts(colored.blue("Regressions"))
+        with indent(2):
+            for regression in profile['regressions']:
+                puts(colored.yellow("{minion}: {name} {duration:.0f} ms, previously "
+                     "{previous_mean:.0f} ms".format(**regression)))
+
+        puts(colored.blue("Critical paths"))
+        for minion, path in sorted(profile['critical_paths'].items()):
+            with indent(2):
+                puts("%s: %.1f s" % (minion, path['total'] / 1000))
+                with indent(2):
+                    for step in path['steps']:
+                        puts("#{run_num:<5} {duration:8.0f} ms, done at {elapsed:8.0f} ms  "
+                             "{name}".format(**step))
+
+
+@SaltPad.subcommand("diff")
+class Diff(cli.Application):
+    """Show states added, removed or changed between two jobs of a minion, its
+    two latest highstate tests by default
+    """
+
+    def main(self, minion, old_jid=None, new_jid=None):
+        client = self.parent.client
+        if old_jid is None or new_jid is None:
+            jids = client.latest_jids(minion)
+            if len(jids) < 2:
+                puts(colored.red("Less than two finished jobs on %s, abort!" % minion))
+                sys.exit(1)
+            new_jid, old_jid = jids
+
+        try:
+            diff = client.diff_jobs(minion, old_jid, new_jid)
+        except ValueError as e:
+            puts(colored.red(str(e)))
+            sys.exit(1)
+
+        puts(colored.blue("Diff of %s between jobs %s and %s" % (minion, old_jid, new_jid)))
+        for change in diff['added']:
+            puts(colored.green("+ %(name)s: %(new)s" % change))
+        for change in diff['removed']:
+            puts(colored.red("- %(name)s: %(old)s" % change))
+        for change in diff['status_changed']:
+            puts(colored.yellow("~ %(name)s: %(old)s -> %(new)s" % change))
+            with indent(4):
+                puts("%(new_comment)s" % change)
+        for change in diff['comment_changed']:
+            puts("~ %(name)s: %(new_comment)s" % change)
+
+
+@SaltPad.subcommand("compare")
+class Compare(cli.Application):
+    """Show states whose latest highstate test result differs between minions
+    matching patterns
+    """
+
+    role = cli.SwitchAttr("--role", str, default=None, help="Only minions with this role")
+
+    def main(self, *patterns):
+        client = self.parent.client
+        minions = client.select_minions(self.role, patterns)
+        differing = client.compare_minions(minions)
+
+        for state_id, results in sorted(differing.items()):
+            puts(colored.yellow(state_id))
+            with indent(4):
+                for minion, result in sorted(results.items()):
+                    puts("%s: %s" % (minion, result))
+
+
+@SaltPad.subcommand("export")
+class Export(cli.Application):
+    """Stream jobs summaries, states results or fleet presence of minions
+    matching patterns as NDJSON or CSV
+    """
+
+    role = cli.SwitchAttr("--role", str, default=None, help="Only minions with this role")
+    key = cli.SwitchAttr("--key", str, default=None, help="Only jobs of this key, ie: state_hightest_test")
+    since = cli.SwitchAttr("--since", str, default=None, help="Only jobs since this YYYY-MM-DD date")
+    format = cli.SwitchAttr("--format", cli.Set(*EXPORT_FORMATS), default="ndjson")
+    output = cli.SwitchAttr(["-o", "--output"], str, default=None, help="Output file, stdout by default")
+
+    def main(self, kind, *patterns):
+        if kind not in EXPORT_FIELDS:
+            puts(colored.red("Unknown export %s, choose among %s" % (kind,
+                eng_join(sorted(EXPORT_FIELDS), conj='or'))))
+            sys.exit(1)
+        try:
+            since = parse_since(self.since) if self.since else None
+        except ValueError:
+            puts(colored.red("--since should be a YYYY-MM-DD date"))
+            sys.exit(1)
+
+        rows = self.parent.client.export(kind, self.role, patterns or None,
+            self.key, since)
+        output = open(self.output, 'wb') if self.output else sys.stdout
+        try:
+            for chunk in serialize(rows, kind, self.format):
+                output.write(chunk)
+        finally:
+            if self.output:
+                output.close()
+
+
+@SaltPad.subcommand("masters")
+class Masters(cli.Application):
+    """Query every master for its minions and show how long each one took
+    """
+
+    def main(self):
+        client = self.parent.client
+        minions = client.minions
+        up = set(minions['up'])
+        counts = {}
+        for minion, master in minions['masters'].items():
+            counts.setdefault(master, {'up': 0, 'down': 0})
+            counts[master]['up' if minion in up else 'down'] += 1
+
+        for master in client.master_latencies():
+            master_counts = counts.get(master['name'], {'up': 0, 'down': 0})
+            line = "%s: %s, %d up, %d down" % (master['name'], master['status'],
+                master_counts['up'], master_counts['down'])
+            if master['last'] is not None:
+                line += ", answered in %.0f ms" % (master['last'] * 1000)
+            if master['status'] == 'ok':
+                puts(colored.green(line))
+            else:
+                puts(colored.red(line))
+
+
+@SaltPad.subcommand("query")
+class Query(cli.Application):
+    """Search minions by attributes, ie: role=web,db version=2014.1.0 sync=failed
+    Attributes are status, role, version, sync and cached grains
+    """
+
+    def main(self, *terms):
+        try:
+            minions = self.parent.client.query(" ".join(terms))
+        except ValueError as e:
+            puts(colored.red(str(e)))
+            sys.exit(1)
+
+        for minion in minions:
+            puts(minion)
+
+
 def main():
     SaltPad.run()
 
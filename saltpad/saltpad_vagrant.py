@@ -6,8 +6,13 @@ import sys
 import json
 import logging
 import operator
+import fnmatch
+import yaml
 
-from subprocess import check_output
+from subprocess import check_output, call as subprocess_call, Popen, PIPE, STDOUT
+from subprocess import CalledProcessError
+from threading import Lock
+from tempfile import gettempdir
 from saltpad import SaltPad, parse_step_name, call, bool_choice, return_output
 from saltpad import Deploy as BaseDeploy
 from plumbum import cli, local, FG
@@ -15,15 +20,249 @@ from vagrant import Vagrant, SandboxVagrant
 from clint.eng import join as eng_join
 from clint.textui import colored, puts, indent
 from os import listdir, mkdir
-from os.path import expanduser, isfile, join, isdir, split, abspath
-from jinja2 import Environment, meta
-from shutil import copy
-from time import sleep
+from os.path import expanduser, isfile, join, isdir, split, abspath, getmtime
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, meta
+from hashlib import sha1
+from shutil import copy, rmtree
+from time import sleep, time
+from multiprocessing.pool import ThreadPool
+
+
+STATUS_CACHE_FILE = expanduser("~/.saltpad_status.json")
+STATUS_CACHE_TTL = 30
+
+MINION_READY_TIMEOUT = 120
+
+VAGRANT_PLUGINS_FILE = expanduser("~/.vagrant.d/plugins.json")
+PLUGINS_CACHE_FILE = expanduser("~/.saltpad_plugins.json")
+
+FRESH_SNAPSHOT = "saltpad-fresh"
+
+TEMPLATES_CACHE_DIR = expanduser("~/.saltpad_templates")
+
+MASTER_MINIONS_KEYS_DIR = "/etc/salt/pki/master/minions"
+
+SSH_CONTROL_PATH = join(gettempdir(), "saltpad-ssh-%r@%h:%p")
+SSH_CONTROL_PERSIST = 300
+
+
+class GuestCommandRunner(object):
+    """Run shell commands on a Vagrant guest.
+
+    `vagrant ssh-config` is resolved once and stored in the VM .vagrant
+    directory, then every command goes through plain ssh reusing a single
+    multiplexed connection (ControlMaster) instead of paying `vagrant ssh`
+    startup and a new handshake each time. A stored config ssh cannot
+    connect with is resolved again.
+    """
+
+    def __init__(self, minion_path):
+        self.minion_path = minion_path
+        self.ssh_config_file = join(minion_path, '.vagrant', 'saltpad_ssh_config')
+
+    def resolve_ssh_config(self):
+        if not isfile(self.ssh_config_file):
+            ssh_config = Vagrant(self.minion_path).ssh_config()
+            with open(self.ssh_config_file, 'w') as f:
+                f.write(ssh_config)
+        return self.ssh_config_file
+
+    def ssh_command(self, *args):
+        return ['ssh', '-F', self.resolve_ssh_config(),
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=%s' % SSH_CONTROL_PATH,
+                '-o', 'ControlPersist=%s' % SSH_CONTROL_PERSIST] + list(args)
+
+    def run(self, command):
+        cached = isfile(self.ssh_config_file)
+        try:
+            return check_output(self.ssh_command('default', command))
+        except CalledProcessError as e:
+            # ssh could not connect, the VM may have been reloaded outside
+            # saltpad with another forwarded port: resolve it again once
+            if e.returncode != 255 or not cached:
+                raise
+            self.close()
+            return check_output(self.ssh_command('default', command))
+
+    def close(self):
+        """Stop the master connection and forget the ssh config, to be
+        called when the VM is halted, destroyed or re-created.
+        """
+        if not isfile(self.ssh_config_file):
+            return
+        with open(os.devnull, 'w') as devnull:
+            subprocess_call(self.ssh_command('-O', 'exit', 'default'),
+                stdout=devnull, stderr=devnull)
+        os.remove(self.ssh_config_file)
 
 
 def get_output_cmd(command, minion_path):
-    with local.cwd(minion_path):
-        return check_output("vagrant ssh -c \"{0}\"".format(command), shell=True)
+    return GuestCommandRunner(minion_path).run(command)
+
+
+def wait_for_minion(client, minion_name, timeout=MINION_READY_TIMEOUT):
+    puts(colored.blue("Wait for salt-minion to connect"))
+    start = time()
+    if client.wait_for_minion(minion_name, timeout):
+        puts(colored.blue("Minion %s connected after %.1f seconds" % (minion_name, time() - start)))
+        return True
+    puts(colored.yellow("Minion %s did not connect after %s seconds" % (minion_name, timeout)))
+    return False
+
+
+def get_vagrant_plugins(minion_path):
+    """Return installed vagrant plugin names, cached until the vagrant plugin
+    registry changes.
+    """
+    mtime = None
+    if isfile(VAGRANT_PLUGINS_FILE):
+        mtime = getmtime(VAGRANT_PLUGINS_FILE)
+
+    if isfile(PLUGINS_CACHE_FILE):
+        try:
+            with open(PLUGINS_CACHE_FILE) as f:
+                cache = json.load(f)
+            if cache.get('mtime') == mtime:
+                return cache['plugins']
+        except ValueError:
+            pass
+
+    plugins = [plugin.name for plugin in Vagrant(minion_path).plugin_list()]
+    with open(PLUGINS_CACHE_FILE, 'w') as f:
+        json.dump({'mtime': mtime, 'plugins': plugins}, f)
+    return plugins
+
+
+def vagrant_snapshot(minion_path, *args):
+    with open(os.devnull, 'w') as devnull:
+        return check_output(['vagrant', 'snapshot'] + list(args),
+            cwd=minion_path, stderr=devnull)
+
+
+def list_snapshots(minion_path):
+    try:
+        output = vagrant_snapshot(minion_path, 'list')
+    except CalledProcessError:
+        # VM not created or snapshots not supported by vagrant/provider
+        return []
+    return [line.strip() for line in output.splitlines()
+            if line.strip() and not line.startswith('==>')]
+
+
+def save_snapshot(minion_path, snapshot_name):
+    if snapshot_name in list_snapshots(minion_path):
+        vagrant_snapshot(minion_path, 'delete', snapshot_name)
+    vagrant_snapshot(minion_path, 'save', snapshot_name)
+
+
+def restore_snapshot(client, project_name, minion_path, snapshot_name):
+    puts(colored.blue("Restore snapshot %s on VM %s" % (snapshot_name, project_name)))
+    vagrant_snapshot(minion_path, 'restore', '--no-provision', snapshot_name)
+    GuestCommandRunner(minion_path).close()
+    invalidate_status_cache()
+    puts(colored.blue("Done"))
+
+    # A restored minion usually reconnects by itself, restart it otherwise
+    if not wait_for_minion(client, project_name, MINION_READY_TIMEOUT / 4):
+        get_output_cmd("sudo /etc/init.d/salt-minion restart", minion_path)
+        puts(colored.blue("Restarted salt-minion"))
+        wait_for_minion(client, project_name)
+
+
+def get_template_variables(vagrantfile, env, source):
+    """Return variables needed by the template besides project_name. They are
+    stored in the templates cache directory keyed by the template mtime and
+    checksum, and only computed again when the template changes.
+    """
+    registry_file = join(TEMPLATES_CACHE_DIR, 'variables.json')
+    registry = {}
+    if isfile(registry_file):
+        try:
+            with open(registry_file) as f:
+                registry = json.load(f)
+        except ValueError:
+            pass
+
+    mtime = getmtime(vagrantfile)
+    entry = registry.get(vagrantfile, {})
+    if entry.get('mtime') == mtime:
+        return set(entry['variables'])
+
+    checksum = sha1(source.encode('utf-8')).hexdigest()
+    if entry.get('checksum') != checksum:
+        variables = meta.find_undeclared_variables(env.parse(source))
+        variables.discard('project_name')
+        entry = {'checksum': checksum, 'variables': sorted(variables)}
+    entry['mtime'] = mtime
+    registry[vagrantfile] = entry
+
+    with open(registry_file, 'w') as f:
+        json.dump(registry, f)
+    return set(entry['variables'])
+
+
+def load_vagrantfile_template(vagrantfile):
+    """Return the compiled Vagrantfile template and the variables it needs
+    besides project_name. Compiled templates are kept in a jinja2 bytecode
+    cache so an unchanged template is never parsed again.
+    """
+    if not isdir(TEMPLATES_CACHE_DIR):
+        mkdir(TEMPLATES_CACHE_DIR)
+
+    template_dir, template_name = split(vagrantfile)
+    env = Environment(loader=FileSystemLoader(template_dir),
+        bytecode_cache=FileSystemBytecodeCache(TEMPLATES_CACHE_DIR))
+    source = env.loader.get_source(env, template_name)[0]
+
+    return (env.get_template(template_name),
+            get_template_variables(vagrantfile, env, source))
+
+
+def generate_minion_keys(minion):
+    project_name, project_path = minion
+    check_output(['salt-key', '--gen-keys=%s' % project_name,
+                  '--gen-keys-dir=%s' % project_path])
+
+
+def get_vagrant_status(minion_path):
+    try:
+        return Vagrant(minion_path).status()['default']
+    except Exception as e:
+        return "unknown (%s)" % e
+
+
+def read_status_cache(minions, ttl=STATUS_CACHE_TTL):
+    """Return cached statuses if they are fresh and match registered VMs,
+    None otherwise.
+    """
+    if not isfile(STATUS_CACHE_FILE):
+        return None
+
+    try:
+        with open(STATUS_CACHE_FILE) as f:
+            cache = json.load(f)
+    except ValueError:
+        return None
+
+    if time() - cache.get('timestamp', 0) > ttl:
+        return None
+    if cache.get('paths') != minions:
+        return None
+    return cache['statuses']
+
+
+def write_status_cache(minions, statuses):
+    with open(STATUS_CACHE_FILE, 'w') as f:
+        json.dump({'timestamp': time(), 'paths': minions,
+                   'statuses': statuses}, f)
+
+
+def invalidate_status_cache():
+    try:
+        os.remove(STATUS_CACHE_FILE)
+    except OSError:
+        pass
 
 
 class VagrantManagerMixin(object):
@@ -33,7 +272,9 @@ class VagrantManagerMixin(object):
         vagrant = Vagrant(minion_path, quiet_stdout=False, quiet_stderr=False)
 
         puts(colored.blue("Execute vagrant %s on minion %s" % (command, project_name)))
+        GuestCommandRunner(minion_path).close()
         getattr(vagrant, command)()
+        invalidate_status_cache()
 
         puts(colored.blue("Done"))
 
@@ -49,12 +290,19 @@ class RegisterDir(cli.Application):
         templates_directory = abspath(templates_directory)
         puts(colored.blue("Looking in %s for templates" % templates_directory))
 
+        vagrantfiles = {}
+        minions_confs = {}
+
         # Check for VagrantFile template file
         vagrantfile_template = join(templates_directory, 'Vagrantfile.template')
         if isfile(vagrantfile_template):
             puts(colored.blue("Found a Vagrantfile template: %s" % vagrantfile_template))
 
-            self.parent.config.setdefault('vagrantfiles', {})['default'] = vagrantfile_template
+            # Compile it now so VM creation does not have to
+            _, variables = load_vagrantfile_template(vagrantfile_template)
+            puts(colored.blue("Template variables: %s" % eng_join(sorted(variables), im_a_moron=True)))
+
+            vagrantfiles['default'] = vagrantfile_template
         else:
             puts(colored.yellow("No Vagrantfile template found: %s" % vagrantfile_template))
 
@@ -67,12 +315,15 @@ class RegisterDir(cli.Application):
                 filepath = join(minions_conf, filename)
                 puts(colored.blue("Found minion conf: %s" % filepath))
 
-                self.parent.config.setdefault('minion_conf', {})[filename] = filepath
+                minions_confs[filename] = filepath
         else:
             puts(colored.yellow("No minion configuration directory found: %s" % minions_conf))
 
         # Write config file
-        self.parent.write_config_file()
+        with self.parent.config_store.transaction() as config:
+            config.setdefault('vagrantfiles', {}).update(vagrantfiles)
+            config.setdefault('minion_conf', {}).update(minions_confs)
+        self.parent.config = config
 
 
 @SaltPad.subcommand("create_vm")
@@ -128,12 +379,7 @@ class CreateVm(cli.Application, VagrantManagerMixin):
         puts(colored.blue("Using %s as VagrantFile template" % vagrantfile))
 
         # Get declared variables
-        env = Environment()
-        with open(vagrantfile) as f:
-            vagrantfile_template = f.read()
-
-        missing_variables = meta.find_undeclared_variables(env.parse(vagrantfile_template))
-        missing_variables.remove('project_name')
+        vagrantfile_template, missing_variables = load_vagrantfile_template(vagrantfile)
         variables = {'project_name': project_name}
 
         if missing_variables:
@@ -144,7 +390,7 @@ class CreateVm(cli.Application, VagrantManagerMixin):
             variables[variable_name] = raw_input("%s: " % variable_name)
 
         # Render vagrantfile
-        rendered_vagrantfile = env.from_string(vagrantfile_template).render(variables)
+        rendered_vagrantfile = vagrantfile_template.render(variables)
 
         # Create directory
         mkdir(project_path)
@@ -159,9 +405,7 @@ class CreateVm(cli.Application, VagrantManagerMixin):
         call("cp %s/%s.pub /etc/salt/pki/master/minions/%s" % (project_path, project_name, project_name))
 
         # Register VM
-        self.parent.config.setdefault('minions', {})[project_name] = project_path
-
-        self.parent.write_config_file()
+        self.parent.update_config('minions', {project_name: project_path})
 
         puts(colored.blue("Done"))
 
@@ -183,23 +427,177 @@ class CreateVm(cli.Application, VagrantManagerMixin):
             VagrantUp.run(['up', project_name])
 
 
+@SaltPad.subcommand("create_vms")
+class CreateVms(cli.Application):
+    """
+    Create VMs listed in a YAML or JSON manifest without prompting. The
+    manifest holds a `vms` list of mappings with a `project_name` and
+    optional `path`, `minion_conf` and `variables` keys. Top-level
+    `minion_conf`, `vagrantfile` and `variables` keys give defaults.
+    """
+
+    workers = cli.SwitchAttr("--workers", int, default=8,
+        help="Number of minion keys to generate in parallel")
+
+    def main(self, manifest_file):
+        with open(manifest_file) as f:
+            manifest = yaml.safe_load(f)
+
+        config = self.parent.config
+        minions_confs = config.get('minion_conf', {})
+        vagrantfile = config.get('vagrantfiles', {}).get(
+            manifest.get('vagrantfile', 'default'))
+        if vagrantfile is None:
+            puts(colored.red("Unknown Vagrantfile template, use register_dir"
+                " command to register one."))
+            sys.exit(1)
+
+        puts(colored.blue("Using %s as VagrantFile template" % vagrantfile))
+        vagrantfile_template, template_variables = load_vagrantfile_template(vagrantfile)
+
+        # Check the whole manifest before creating anything
+        vms = []
+        errors = []
+        registered = config.get('minions', {})
+        seen_names = set()
+        seen_paths = set()
+        for num, vm in enumerate(manifest.get('vms', [])):
+            project_name = vm.get('project_name')
+            if not project_name:
+                errors.append("VM #%d: missing project_name" % (num + 1))
+                continue
+            project_path = abspath(vm.get('path', project_name))
+
+            if project_name in seen_names:
+                errors.append("%s: project_name declared twice" % project_name)
+            if project_name in registered:
+                errors.append("%s: already registered in %s" % (project_name,
+                    registered[project_name]))
+            if project_path in seen_paths:
+                errors.append("%s: path %s declared twice" % (project_name, project_path))
+            seen_names.add(project_name)
+            seen_paths.add(project_path)
+
+            minion_conf = vm.get('minion_conf', manifest.get('minion_conf'))
+            if minion_conf is None and len(minions_confs) == 1:
+                minion_conf = minions_confs.keys()[0]
+
+            variables = dict(manifest.get('variables', {}))
+            variables.update(vm.get('variables', {}))
+            variables['project_name'] = project_name
+
+            if isdir(project_path):
+                errors.append("%s: directory %s already exists" % (project_name, project_path))
+            if minion_conf not in minions_confs:
+                errors.append("%s: unknown minion configuration %s" % (project_name, minion_conf))
+            missing_variables = template_variables - set(variables)
+            if missing_variables:
+                errors.append("%s: missing template variables %s" % (project_name,
+                    eng_join(sorted(missing_variables), im_a_moron=True)))
+
+            vms.append((project_name, project_path, minions_confs.get(minion_conf), variables))
+
+        if not vms and not errors:
+            errors.append("No VMs declared in %s" % manifest_file)
+        if errors:
+            for error in errors:
+                puts(colored.red(error))
+            sys.exit(1)
+
+        # Nothing is registered until every VM is complete, clean up on
+        # failure so the manifest can be run again
+        created = []
+        master_keys = []
+        try:
+            # Create directories
+            for project_name, project_path, minion_conf, variables in vms:
+                mkdir(project_path)
+                created.append(project_path)
+                copy(minion_conf, join(project_path, 'minion'))
+                with open(join(project_path, 'Vagrantfile'), 'w') as f:
+                    f.write(vagrantfile_template.render(variables))
+
+            # Generate keys
+            puts(colored.blue("Generating keys for %s minions" % len(vms)))
+            pool = ThreadPool(min(self.workers, len(vms)))
+            try:
+                pool.map(generate_minion_keys, [vm[:2] for vm in vms])
+            finally:
+                pool.close()
+                pool.join()
+
+            # Copy them on master in one pass
+            for project_name, project_path, _, _ in vms:
+                master_key = join(MASTER_MINIONS_KEYS_DIR, project_name)
+                copy(join(project_path, '%s.pub' % project_name), master_key)
+                master_keys.append(master_key)
+        except (Exception, KeyboardInterrupt) as e:
+            puts(colored.red("Creation failed (%s), removing created VMs" % e))
+            for master_key in master_keys:
+                os.remove(master_key)
+            for project_path in created:
+                rmtree(project_path, ignore_errors=True)
+            sys.exit(1)
+
+        # Register VMs
+        self.parent.update_config('minions',
+            dict((vm[0], vm[1]) for vm in vms))
+
+        puts(colored.blue("Created %s" % eng_join([vm[0] for vm in vms], im_a_moron=True)))
+
+
 @SaltPad.subcommand("status")
 class Status(cli.Application):
 
+    workers = cli.SwitchAttr("--workers", int, default=8,
+        help="Number of vagrant status probes to run in parallel")
+    refresh = cli.Flag("--refresh", default=False,
+        help="Ignore cached statuses and probe VMs again")
+
+    def collect_statuses(self, minions):
+        if not minions:
+            return {}
+
+        names = sorted(minions)
+        pool = ThreadPool(min(self.workers, len(names)))
+        try:
+            vagrant_statuses = pool.map(get_vagrant_status,
+                [minions[name] for name in names])
+        finally:
+            pool.close()
+            pool.join()
+
+        # Salt presence is fetched once by the client and shared by all VMs
+        statuses = {}
+        for minion_name, vagrant_status in zip(names, vagrant_statuses):
+            statuses[minion_name] = {
+                'vagrant': vagrant_status,
+                'salt': self.parent.client.get_minion_status(minion_name)}
+        return statuses
+
     def main(self):
-        for minion_name, minion_path in self.parent.config.get('minions', {}).items():
-            vagrant = Vagrant(minion_path)
-            vagrant_status = vagrant.status()['default']
-            salt_status = self.parent.client.get_minion_status(minion_name)
+        minions = self.parent.config.get('minions', {})
+
+        statuses = None
+        if not self.refresh:
+            statuses = read_status_cache(minions)
+        if statuses is None:
+            statuses = self.collect_statuses(minions)
+            write_status_cache(minions, statuses)
+
+        for minion_name in sorted(statuses):
             puts("%s:" % minion_name)
             with indent(4):
-                puts("vagrant status: %s" % vagrant_status)
-                puts("saltstack status: %s" % salt_status)
+                puts("vagrant status: %s" % statuses[minion_name]['vagrant'])
+                puts("saltstack status: %s" % statuses[minion_name]['salt'])
 
 
 @SaltPad.subcommand("up")
 class VagrantUp(cli.Application, VagrantManagerMixin):
 
+    snapshot = cli.Flag("--snapshot", default=False,
+        help="Save VM as the %s snapshot used by clean" % FRESH_SNAPSHOT)
+
     def main(self, project_name):
         minion_path = self.parent.config['minions'][project_name]
         self.execute_vagrant_command_on_minion(project_name, 'up')
@@ -236,21 +634,21 @@ class VagrantUp(cli.Application, VagrantManagerMixin):
             check_output(command, shell=True)
 
             # Wait for minion to connect
-            sleep(10)
+            wait_for_minion(self.parent.client, project_name)
 
             puts(colored.blue("Master ip has been updated from {0} to {1}".format(declared_master_ip, master_ip)))
             change = True
         else:
             puts(colored.blue("Master is good"))
 
-        # Check if sahara is available
-        minion_path = self.parent.config['minions'][project_name]
-        try:
-            plugins = Vagrant(minion_path).plugin_list()
-        except Exception as e:
-            raise
+        if self.snapshot:
+            puts(colored.blue("Save snapshot %s" % FRESH_SNAPSHOT))
+            save_snapshot(minion_path, FRESH_SNAPSHOT)
+            puts(colored.blue("Done"))
+            return
 
-        sahara = bool([p for p in plugins if p.name == "sahara"])
+        # Check if sahara is available
+        sahara = "sahara" in get_vagrant_plugins(minion_path)
 
         if not sahara:
             message = "Sandbox support is not available, please install sahara"\
@@ -307,23 +705,74 @@ class VagrantSSH(cli.Application):
             call('vagrant ssh')
 
 
-@SaltPad.subcommand("deploy")
-class Deploy(BaseDeploy):
+@SaltPad.subcommand("snapshot")
+class Snapshot(cli.Application):
+    """Manage named snapshots of VMs"""
+
+    def main(self, *args):
+        if args:
+            print "Unknown command %r" % (args[0],)
+            return 1
+        if not self.nested_command:
+            print "No command given"
+            self.help()
+            return 1
+
+
+@Snapshot.subcommand("save")
+class SnapshotSave(cli.Application):
+    """Save VM state under a snapshot name, clean restores saltpad-fresh"""
+
+    def main(self, project_name, snapshot_name=FRESH_SNAPSHOT):
+        minion_path = self.parent.parent.config['minions'][project_name]
+        puts(colored.blue("Save snapshot %s on VM %s" % (snapshot_name, project_name)))
+        save_snapshot(minion_path, snapshot_name)
+        puts(colored.blue("Done"))
+
+
+@Snapshot.subcommand("restore")
+class SnapshotRestore(cli.Application):
+
+    def main(self, project_name, snapshot_name=FRESH_SNAPSHOT):
+        minion_path = self.parent.parent.config['minions'][project_name]
+        restore_snapshot(self.parent.parent.client, project_name, minion_path,
+            snapshot_name)
+
+
+@Snapshot.subcommand("delete")
+class SnapshotDelete(cli.Application):
+
+    def main(self, project_name, snapshot_name=FRESH_SNAPSHOT):
+        minion_path = self.parent.parent.config['minions'][project_name]
+        vagrant_snapshot(minion_path, 'delete', snapshot_name)
+        puts(colored.blue("Done"))
+
+
+@Snapshot.subcommand("list")
+class SnapshotList(cli.Application):
+
+    def main(self, *projects_names):
+        minions = self.parent.parent.config.get('minions', {})
+        for project_name in (projects_names or sorted(minions)):
+            puts("%s:" % project_name)
+            with indent(4):
+                for snapshot_name in list_snapshots(minions[project_name]):
+                    puts(snapshot_name)
 
-    clean = cli.Flag("--clean", default=False, help="Clean VM before deploying it")
-    force_clean = cli.Flag("--force-clean", default=False, help="Force destroy VM")
+
+class VagrantCleanMixin(object):
 
     def do_clean(self, project_name):
         minion_path = self.parent.config['minions'][project_name]
 
-        # Check if sahara is available
-        minion_path = self.parent.config['minions'][project_name]
-        try:
-            plugins = Vagrant(minion_path).plugin_list()
-        except Exception as e:
-            raise
+        # Jump back to the fresh snapshot if there is one
+        if not self.force_clean and FRESH_SNAPSHOT in list_snapshots(minion_path):
+            restore_snapshot(self.parent.client, project_name, minion_path,
+                FRESH_SNAPSHOT)
+            return
 
-        sahara = bool([p for p in plugins if p.name == "sahara"])
+        # Check if sahara is available
+        sahara = "sahara" in get_vagrant_plugins(minion_path)
 
         # Check sandbox status
         sandbox_status = 'off'
@@ -337,6 +786,7 @@ class Deploy(BaseDeploy):
                       "--force-clean option"
             puts(colored.blue(message))
             sandbox.sandbox_rollback()
+            GuestCommandRunner(minion_path).close()
             puts(colored.blue("Done"))
 
             command = "sudo /etc/init.d/salt-minion restart"
@@ -344,8 +794,7 @@ class Deploy(BaseDeploy):
 
             puts(colored.blue("Restarted salt-minion"))
 
-            puts(colored.blue("Wait some time for salt-minion to connect"))
-            sleep(10)
+            wait_for_minion(self.parent.client, project_name)
         # Else destroy and up
         else:
             # Destroy
@@ -356,6 +805,23 @@ class Deploy(BaseDeploy):
             VagrantUp.parent = self.parent
             VagrantUp.run(['up', project_name], exit=False)
 
+
+@SaltPad.subcommand("clean")
+class Clean(cli.Application, VagrantCleanMixin):
+    """Rollback VM sandbox, or destroy and re-create it"""
+
+    force_clean = cli.Flag("--force-clean", default=False, help="Force destroy VM")
+
+    def main(self, project_name):
+        self.do_clean(project_name)
+
+
+@SaltPad.subcommand("deploy")
+class Deploy(BaseDeploy, VagrantCleanMixin):
+
+    clean = cli.Flag("--clean", default=False, help="Clean VM before deploying it")
+    force_clean = cli.Flag("--force-clean", default=False, help="Force destroy VM")
+
     def main(self, project_name):
         # Clean
         if self.clean or self.force_clean:
@@ -364,6 +830,93 @@ class Deploy(BaseDeploy):
         super(Deploy, self).main(project_name)
 
 
+def run_prefixed(command, prefix, output_lock):
+    """Run command, writing its output line by line prefixed with prefix.
+    Return the command exit code.
+    """
+    with open(os.devnull) as devnull:
+        process = Popen(command, stdin=devnull, stdout=PIPE, stderr=STDOUT)
+        for line in iter(process.stdout.readline, ''):
+            with output_lock:
+                sys.stdout.write("[%s] %s" % (prefix, line))
+                sys.stdout.flush()
+        return process.wait()
+
+
+@SaltPad.subcommand("deploy_many")
+class DeployMany(cli.Application):
+    """Clean and deploy several registered VMs in parallel, VMs are given by
+    name or glob pattern
+    """
+
+    clean = cli.Flag("--clean", default=False, help="Clean VMs before deploying them")
+    force_clean = cli.Flag("--force-clean", default=False, help="Force destroy VMs")
+    workers = cli.SwitchAttr("--workers", int, default=4,
+        help="Number of VMs to process in parallel")
+
+    def match_minions(self, patterns):
+        registered = sorted(self.parent.config.get('minions', {}))
+        matched = []
+        for pattern in patterns:
+            for minion_name in fnmatch.filter(registered, pattern):
+                if minion_name not in matched:
+                    matched.append(minion_name)
+        return matched
+
+    def process_minion(self, minion_name):
+        # Each phase runs in its own saltpad-vagrant process so output can be
+        # prefixed and prompts fall back to their default answer
+        base_command = [sys.executable, abspath(sys.argv[0])]
+        phases = []
+        if self.clean or self.force_clean:
+            command = base_command + ['clean', minion_name]
+            if self.force_clean:
+                command.append('--force-clean')
+            phases.append(('clean', command))
+        phases.append(('deploy', base_command + ['deploy', minion_name]))
+
+        timings = []
+        for phase_name, command in phases:
+            start = time()
+            return_code = run_prefixed(command, minion_name, self.output_lock)
+            timings.append((phase_name, time() - start))
+            if return_code != 0:
+                return minion_name, False, timings
+        return minion_name, True, timings
+
+    def main(self, *patterns):
+        minions = self.match_minions(patterns)
+        if not minions:
+            puts(colored.red("No registered VMs matching, abort!"))
+            sys.exit(1)
+
+        puts(colored.blue("Processing %s" % eng_join(minions, im_a_moron=True)))
+
+        self.output_lock = Lock()
+        start = time()
+        pool = ThreadPool(min(self.workers, len(minions)))
+        try:
+            results = pool.map(self.process_minion, minions)
+        finally:
+            pool.close()
+            pool.join()
+        total = time() - start
+
+        puts()
+        puts(colored.blue("=" * 10))
+        failed = False
+        for minion_name, success, timings in results:
+            report = ", ".join("%s %.1fs" % timing for timing in timings)
+            if success:
+                puts(colored.green("%s: OK (%s)" % (minion_name, report)))
+            else:
+                failed = True
+                puts(colored.red("%s: FAILED (%s)" % (minion_name, report)))
+        puts(colored.blue("Total time: %.1fs" % total))
+
+        if failed:
+            sys.exit(1)
+
 
 def main():
     SaltPad.run()
@@ -33,6 +33,7 @@ setup(
     install_requires=[
     ],
     zip_safe=False,
+    test_suite='tests',
     keywords='saltpad',
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
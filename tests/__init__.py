@@ -0,0 +1,6 @@
+import sys
+
+from os.path import abspath, dirname, join
+
+# SaltPad modules import each other as top-level modules
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'saltpad'))
@@ -0,0 +1,127 @@
+import unittest
+
+from threading import Event, Thread
+
+from cache import TTLCache, make_key, memoize
+
+
+class Computer(object):
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.calls = 0
+
+    @memoize(ttl=60)
+    def compute(self, value):
+        self.calls += 1
+        return value * 2
+
+    @memoize(ttl=60, cache_if=lambda result: result is not None)
+    def maybe(self, value):
+        self.calls += 1
+        return value
+
+
+class TTLCacheTest(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = TTLCache()
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertRaises(KeyError, cache.get, 'other')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_expired(self):
+        cache = TTLCache()
+        cache.set('key', 'value', ttl=-1)
+        self.assertRaises(KeyError, cache.get, 'key')
+        self.assertEqual(cache.misses, 1)
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertRaises(KeyError, cache.get, 'b')
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_peek_does_not_count(self):
+        cache = TTLCache()
+        cache.set('key', 'value')
+        self.assertEqual(cache.peek('key'), 'value')
+        self.assertRaises(KeyError, cache.peek, 'other')
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+    def test_invalidate(self):
+        cache = TTLCache()
+        cache.set(('f', (1,), ()), 1)
+        cache.set(('f', (2,), ()), 2)
+        cache.set(('g', (), ()), 3)
+        cache.invalidate('f', 1)
+        self.assertRaises(KeyError, cache.peek, ('f', (1,), ()))
+        self.assertEqual(cache.peek(('f', (2,), ())), 2)
+        cache.invalidate('f')
+        self.assertRaises(KeyError, cache.peek, ('f', (2,), ()))
+        cache.invalidate()
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_key_locks_are_dropped(self):
+        cache = TTLCache()
+        with cache.lock('key'):
+            self.assertIn('key', cache._key_locks)
+        self.assertEqual(cache._key_locks, {})
+
+    def test_make_key(self):
+        self.assertEqual(make_key([1, {'b': [2], 'a': 1}]),
+                         (1, (('a', 1), ('b', (2,)))))
+
+
+class MemoizeTest(unittest.TestCase):
+
+    def test_counts_one_miss_then_hits(self):
+        computer = Computer(TTLCache())
+        self.assertEqual(computer.compute(2), 4)
+        self.assertEqual((computer.cache.hits, computer.cache.misses), (0, 1))
+        self.assertEqual(computer.compute(2), 4)
+        self.assertEqual((computer.cache.hits, computer.cache.misses), (1, 1))
+        self.assertEqual(computer.calls, 1)
+
+    def test_cache_if(self):
+        computer = Computer(TTLCache())
+        computer.maybe(None)
+        computer.maybe(None)
+        self.assertEqual(computer.calls, 2)
+        computer.maybe(1)
+        computer.maybe(1)
+        self.assertEqual(computer.calls, 3)
+
+    def test_concurrent_misses_compute_once(self):
+        computer = Computer(TTLCache())
+        started = Event()
+        release = Event()
+
+        def slow(self, value):
+            started.set()
+            release.wait()
+            self.calls += 1
+            return value
+
+        computer.slow = memoize(ttl=60)(slow).__get__(computer)
+        results = []
+        threads = [Thread(target=lambda: results.append(computer.slow(1)))
+                   for _ in range(3)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [1, 1, 1])
+        self.assertEqual(computer.calls, 1)
+        # Each call counts once, as a miss or as a hit
+        self.assertEqual(computer.cache.hits + computer.cache.misses, 3)
+        self.assertEqual(computer.cache._key_locks, {})
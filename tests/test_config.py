@@ -0,0 +1,68 @@
+import os
+import json
+import stat
+import shutil
+import tempfile
+import unittest
+
+from os.path import join
+
+from config import ConfigStore
+
+
+class ConfigStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = join(self.directory, 'saltpad.json')
+        self.store = ConfigStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_missing_file(self):
+        self.assertEqual(self.store.load(), {})
+
+    def test_update_and_remove(self):
+        self.store.update('minions', {'web1': '/vms/web1'})
+        self.store.update('minions', {'web2': '/vms/web2'})
+        self.store.update('projects', {'web': 'vagrant'})
+        self.assertEqual(self.store.load(), {'minions': {'web1': '/vms/web1',
+            'web2': '/vms/web2'}, 'projects': {'web': 'vagrant'}})
+
+        config = self.store.remove('minions', 'web1', 'unknown')
+        self.assertEqual(config['minions'], {'web2': '/vms/web2'})
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), config)
+
+    def test_updates_merge_with_other_writers(self):
+        other = ConfigStore(self.path)
+        self.store.update('minions', {'web1': '/vms/web1'})
+        other.update('minions', {'web2': '/vms/web2'})
+        self.store.update('minions', {'web3': '/vms/web3'})
+        self.assertEqual(sorted(self.store.load()['minions']), ['web1', 'web2', 'web3'])
+
+    def test_failed_transaction_keeps_the_file(self):
+        self.store.update('minions', {'web1': '/vms/web1'})
+        try:
+            with self.store.transaction() as config:
+                config['minions'] = {}
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(self.store.load(), {'minions': {'web1': '/vms/web1'}})
+
+    def test_keeps_the_file_mode(self):
+        with open(self.path, 'w') as f:
+            json.dump({}, f)
+        os.chmod(self.path, 0644)
+        self.store.update('minions', {'web1': '/vms/web1'})
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0644)
+
+    def test_new_file_follows_the_umask(self):
+        umask = os.umask(022)
+        try:
+            self.store.update('minions', {'web1': '/vms/web1'})
+        finally:
+            os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0644)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import unittest
+
+from cStringIO import StringIO
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from export import EXPORT_FIELDS, chunked, csv_value, parse_since, serialize
+from export import to_csv, to_ndjson
+
+
+class SerializeTest(unittest.TestCase):
+
+    rows = [{'minion': 'web1', 'presence': 'up', 'roles': ['web', 'db'],
+             'sync_status': 'success', 'sync_time': None},
+            {'minion': u'caf\xe9', 'presence': 'down', 'roles': [],
+             'sync_status': None, 'sync_time': None}]
+
+    def test_csv_value(self):
+        self.assertEqual(csv_value(None), '')
+        self.assertEqual(csv_value(['web', 'db']), 'web db')
+        self.assertEqual(csv_value(u'caf\xe9'), 'caf\xc3\xa9')
+        self.assertEqual(csv_value(1.5), '1.5')
+
+    def test_to_csv(self):
+        output = ''.join(to_csv(iter(self.rows), EXPORT_FIELDS['presence']))
+        lines = list(csv.reader(StringIO(output)))
+        self.assertEqual(lines[0], EXPORT_FIELDS['presence'])
+        self.assertEqual(lines[1], ['web1', 'up', 'web db', 'success', ''])
+        self.assertEqual(lines[2], ['caf\xc3\xa9', 'down', '', '', ''])
+
+    def test_to_csv_header_only(self):
+        self.assertEqual(''.join(to_csv(iter([]), ['a', 'b'])), 'a,b\r\n')
+
+    def test_to_ndjson(self):
+        lines = list(to_ndjson(iter([{'time': datetime(2014, 1, 2)}, {'a': 1}])))
+        self.assertEqual(lines, ['{"time": "2014-01-02 00:00:00"}\n', '{"a": 1}\n'])
+
+    def test_chunked(self):
+        self.assertEqual(list(chunked(['ab', 'cd', 'e'], size=3)), ['abcd', 'e'])
+        self.assertEqual(list(chunked([], size=3)), [])
+
+    def test_serialize(self):
+        output = ''.join(serialize(iter(self.rows), 'presence', 'ndjson'))
+        self.assertEqual([json.loads(line)['minion'] for line in output.splitlines()],
+                         ['web1', u'caf\xe9'])
+        self.assertRaises(ValueError, serialize, iter(self.rows), 'presence', 'xml')
+
+    def test_parse_since(self):
+        since = parse_since('2014-03-01')
+        self.assertEqual(since.generation_time.replace(tzinfo=None), datetime(2014, 3, 1))
+        self.assertTrue(ObjectId.from_datetime(datetime(2014, 2, 28)) < since)
+        self.assertRaises(ValueError, parse_since, 'yesterday')
@@ -0,0 +1,55 @@
+import unittest
+
+from index import FleetIndex, parse_query
+
+
+class FleetIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = FleetIndex()
+        self.index.update('web1', 'role', ['web', 'cache'])
+        self.index.update('web2', 'role', 'web')
+        self.index.update('db1', 'role', ['db'])
+        self.index.update('web1', 'sync', 'failed')
+        self.index.update('web2', 'sync', 'success')
+        self.index.update('db1', 'sync', 'failed')
+
+    def test_query(self):
+        self.assertEqual(self.index.query([('role', ['web'])]), ['web1', 'web2'])
+        self.assertEqual(self.index.query([('role', ['web']), ('sync', ['failed'])]),
+                         ['web1'])
+        self.assertEqual(self.index.query([('role', ['web', 'db']), ('sync', ['failed'])]),
+                         ['db1', 'web1'])
+        self.assertEqual(self.index.query([('role', ['unknown'])]), [])
+
+    def test_query_without_criteria(self):
+        self.assertEqual(self.index.query([]), ['db1', 'web1', 'web2'])
+
+    def test_update_replaces_values(self):
+        self.index.update('web1', 'role', ['db'])
+        self.assertEqual(self.index.query([('role', ['web'])]), ['web2'])
+        self.assertEqual(self.index.query([('role', ['db'])]), ['db1', 'web1'])
+        self.assertNotIn(('role', u'cache'), self.index.postings)
+
+    def test_values_are_unicode(self):
+        self.index.update('web1', 'cpus', 4)
+        self.assertEqual(self.index.query([('cpus', ['4'])]), ['web1'])
+
+    def test_remove(self):
+        self.index.remove('web1')
+        self.assertEqual(self.index.query([]), ['db1', 'web2'])
+        self.assertEqual(self.index.query([('sync', ['failed'])]), ['db1'])
+        # Unknown minions are ignored
+        self.index.remove('web1')
+
+
+class ParseQueryTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_query('role=web,db version=2014.1.0 sync=failed'),
+                         [('role', ['web', 'db']), ('version', ['2014.1.0']),
+                          ('sync', ['failed'])])
+        self.assertEqual(parse_query(''), [])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parse_query, 'role')
@@ -0,0 +1,111 @@
+import unittest
+
+from jobs import compare_returns, decode_return, diff_returns, encode_return
+from jobs import extract_timings, get_return_status, parse_duration
+from jobs import profile_timings, summarize_return
+
+
+def state(result, changes=None, comment='', duration=None, run_num=0, sls=None):
+    return {'result': result, 'changes': changes or {}, 'comment': comment,
+            'duration': duration, '__run_num__': run_num, '__sls__': sls}
+
+
+class ReturnStatusTest(unittest.TestCase):
+
+    def test_status(self):
+        self.assertEqual(get_return_status({'a': state(True)}), 'success')
+        self.assertEqual(get_return_status({'a': state(True), 'b': state(None)}), 'changes')
+        self.assertEqual(get_return_status({'a': state(None), 'b': state(False)}), 'failed')
+        self.assertEqual(get_return_status(['Rendering SLS failed']), 'failed')
+
+    def test_summary(self):
+        summary = summarize_return({'b': state(True, {'diff': 'new'}),
+                                    'a': state(False, {'diff': 'new'}),
+                                    'c': state(True)})
+        self.assertEqual(summary, {'status': 'failed', 'total': 3, 'failed': 1,
+                                   'changes': 2, 'changed_states': ['a', 'b']})
+
+    def test_summary_of_an_error(self):
+        self.assertEqual(summarize_return('error')['status'], 'failed')
+        self.assertEqual(summarize_return('error')['total'], 0)
+
+    def test_encode_decode(self):
+        job_return = {'pkg_|-nginx_|-nginx_|-installed': state(True)}
+        self.assertEqual(decode_return(encode_return(job_return)), job_return)
+
+
+class TimingsTest(unittest.TestCase):
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration('12.5 ms'), 12.5)
+        self.assertEqual(parse_duration(3), 3.0)
+        self.assertEqual(parse_duration(''), 0.0)
+        self.assertEqual(parse_duration(None), 0.0)
+        self.assertEqual(parse_duration('soon'), 0.0)
+
+    def test_extract_timings(self):
+        timings = extract_timings({'a': state(True, duration='2 ms', run_num=1, sls='web'),
+                                   'b': 'not a state'})
+        self.assertEqual(timings, [['a', 1, 2.0, 'web']])
+        self.assertEqual(extract_timings('error'), [])
+
+    def test_profile(self):
+        newest = [['install', 0, 5000.0, 'web'], ['config', 1, 10.0, 'web']]
+        previous = [['install', 0, 1000.0, 'web'], ['config', 1, 20.0, 'web']]
+        profile = profile_timings({'web1': [newest, previous], 'web2': []})
+
+        self.assertEqual([entry['name'] for entry in profile['states']],
+                         ['install', 'config'])
+        install = profile['states'][0]
+        self.assertEqual((install['runs'], install['total'], install['max'],
+                          install['mean'], install['minions']),
+                         (2, 6000.0, 5000.0, 3000.0, 1))
+        self.assertEqual(profile['sls'][0]['total'], 6030.0)
+
+        self.assertEqual(profile['regressions'], [{'minion': 'web1', 'name': 'install',
+            'duration': 5000.0, 'previous_mean': 1000.0}])
+
+        path = profile['critical_paths']['web1']
+        self.assertEqual(path['total'], 5010.0)
+        self.assertEqual([(step['name'], step['elapsed']) for step in path['steps']],
+                         [('install', 5000.0), ('config', 5010.0)])
+        self.assertNotIn('web2', profile['critical_paths'])
+
+    def test_profile_top(self):
+        run = [['a', 0, 1.0, None], ['b', 1, 3.0, None], ['c', 2, 2.0, None]]
+        profile = profile_timings({'web1': [run]}, top=1)
+        self.assertEqual([entry['name'] for entry in profile['states']], ['b'])
+        self.assertEqual(profile['sls'], [])
+        self.assertEqual([step['name'] for step in profile['critical_paths']['web1']['steps']],
+                         ['b'])
+
+
+class DiffTest(unittest.TestCase):
+
+    def test_diff_returns(self):
+        old = {'kept': state(True, comment='ok'), 'fixed': state(False),
+               'reworded': state(True, comment='old'), 'gone': state(True)}
+        new = {'kept': state(True, comment='ok'), 'fixed': state(True),
+               'reworded': state(True, comment='new'), 'added': state(None)}
+        diff = diff_returns(old, new)
+
+        self.assertEqual([change['name'] for change in diff['added']], ['added'])
+        self.assertEqual([change['name'] for change in diff['removed']], ['gone'])
+        self.assertEqual([(change['name'], change['old'], change['new'])
+                          for change in diff['status_changed']], [('fixed', False, True)])
+        self.assertEqual([(change['old_comment'], change['new_comment'])
+                          for change in diff['comment_changed']], [('old', 'new')])
+
+    def test_diff_with_an_error_return(self):
+        diff = diff_returns('Rendering SLS failed', {'a': state(True)})
+        self.assertEqual([change['name'] for change in diff['added']], ['a'])
+
+    def test_compare_returns(self):
+        differing = compare_returns({
+            'web1': {'same': state(True), 'differs': state(True), 'partial': state(True)},
+            'web2': {'same': state(True), 'differs': state(False)},
+        })
+        self.assertEqual(differing, {
+            'differs': {'web1': True, 'web2': False},
+            'partial': {'web1': True, 'web2': 'missing'},
+        })
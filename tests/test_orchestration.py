@@ -0,0 +1,32 @@
+import unittest
+
+from orchestration import minions_tiers, role_tiers
+
+
+class RoleTiersTest(unittest.TestCase):
+
+    def test_tiers(self):
+        dependencies = {'web': ['db', 'cache'], 'cache': ['db'], 'lb': ['web']}
+        self.assertEqual(role_tiers(dependencies),
+                         {'db': 0, 'cache': 1, 'web': 2, 'lb': 3})
+
+    def test_independent_roles(self):
+        self.assertEqual(role_tiers({'web': [], 'db': []}), {'web': 0, 'db': 0})
+        self.assertEqual(role_tiers({}), {})
+
+    def test_cycle(self):
+        self.assertRaises(ValueError, role_tiers,
+                          {'web': ['db'], 'db': ['web'], 'lb': []})
+
+
+class MinionsTiersTest(unittest.TestCase):
+
+    def test_minions_go_with_their_highest_role(self):
+        dependencies = {'web': ['db']}
+        minions_roles = {'web1': ['web'], 'db1': ['db'], 'both': ['db', 'web'],
+                         'other': ['monitoring'], 'bare': []}
+        self.assertEqual(minions_tiers(minions_roles, dependencies),
+                         [['bare', 'db1', 'other'], ['both', 'web1']])
+
+    def test_no_minions(self):
+        self.assertEqual(minions_tiers({}, {'web': ['db']}), [])